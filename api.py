@@ -23,6 +23,7 @@ if missing_vars:
 # Import local routers
 from routes import auth, admin, chatbots, chat, instructor, student, super_admin
 from models import get_embed_model
+from utils import get_tokenizer
 import database_postgres as db
 
 @asynccontextmanager
@@ -34,6 +35,18 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         logging.error(f"✗ Database initialization failed: {e}")
     
+    # Pre-create upload roots so request handlers don't need to mkdir on every upload
+    for upload_root in ("uploads/assignments", "uploads/resources"):
+        os.makedirs(upload_root, exist_ok=True)
+    
+    # Load the tokenizer now so the first upload/chat doesn't pay for reading
+    # (or downloading) the BPE file
+    try:
+        get_tokenizer()
+        logging.info("✓ Tokenizer loaded")
+    except Exception as e:
+        logging.warning(f"Tokenizer preload failed, will retry on first use: {e}")
+    
     # Skip embedding model loading - will be lazy loaded on first use
     logging.info("✓ Server startup complete")
     
@@ -4,11 +4,16 @@ PostgreSQL Database for RAG-LMS with pgvector support
 Manages chatbots, documents, conversations, and feedback
 """
 import psycopg2
+import psycopg2.errors
 import psycopg2.extras
+import psycopg2.pool
 import json
 import logging
+import multiprocessing
 import os
 import sys
+import threading
+import time
 import uuid
 from datetime import datetime, timedelta
 from typing import List, Dict, Optional, Any
@@ -44,21 +49,68 @@ DB_PARAMS = {
     'password': POSTGRES_PASSWORD
 }
 
+# Connection pool sizing (per worker process)
+POSTGRES_POOL_MIN = int(os.getenv('POSTGRES_POOL_MIN', '1'))
+POSTGRES_POOL_MAX = int(os.getenv('POSTGRES_POOL_MAX', '20'))
+
 logger = logging.getLogger("rag-db")
 
+_pool = None
+_pool_lock = threading.Lock()
+# ThreadedConnectionPool raises instead of waiting when exhausted, so callers
+# block on this semaphore until a connection slot is free.
+_pool_slots = threading.BoundedSemaphore(POSTGRES_POOL_MAX)
+
+def _get_pool() -> psycopg2.pool.ThreadedConnectionPool:
+    """Lazily create the connection pool (once per process)"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = psycopg2.pool.ThreadedConnectionPool(POSTGRES_POOL_MIN, POSTGRES_POOL_MAX, **DB_PARAMS)
+    return _pool
+
+def _connection_alive(conn) -> bool:
+    """Pre-ping a pooled connection: psycopg2 only marks it closed after a failed query"""
+    if conn.closed:
+        return False
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()  # end the implicit transaction the ping opened
+        return True
+    except psycopg2.Error:
+        return False
+
 @contextmanager
 def get_db_connection():
-    """Context manager for database connections"""
-    conn = psycopg2.connect(**DB_PARAMS)
+    """Context manager for pooled database connections"""
+    _pool_slots.acquire()
+    try:
+        pool = _get_pool()
+        # After a server restart or idle timeout every idle connection may be dead;
+        # discard them until a live (or freshly opened) one comes out of the pool
+        for _ in range(POSTGRES_POOL_MAX + 1):
+            conn = pool.getconn()
+            if _connection_alive(conn):
+                break
+            pool.putconn(conn, close=True)
+        else:
+            raise psycopg2.OperationalError("No live database connection available from the pool")
+    except Exception:
+        _pool_slots.release()
+        raise
+    
     try:
         yield conn
         conn.commit()
     except Exception as e:
-        conn.rollback()
+        if not conn.closed:
+            conn.rollback()
         logger.error(f"Database error: {e}")
         raise
     finally:
-        conn.close()
+        pool.putconn(conn, close=bool(conn.closed))
+        _pool_slots.release()
 
 def get_dict_cursor(conn):
     """Get a cursor that returns dictionaries"""
@@ -207,19 +259,32 @@ def update_user_password(user_id: str, password_hash: str) -> bool:
                        (password_hash, user_id))
     return True
 
-def list_users(institution_id: str = None) -> List[Dict]:
-    """List all users (optionally filtered by institution)"""
+def list_users(institution_id: str = None, role: str = None,
+               limit: int = None, offset: int = 0) -> List[Dict]:
+    """List all users (optionally filtered by institution and/or role, and paged)"""
     with get_db_connection() as conn:
         with get_dict_cursor(conn) as cur:
             query = "SELECT id, username, email, full_name, role, institution_id, created_at FROM users"
+            conditions = []
             params = []
             
             if institution_id:
-                query += " WHERE institution_id = %s"
+                conditions.append("institution_id = %s")
                 params.append(institution_id)
             
+            if role:
+                conditions.append("role = %s")
+                params.append(role)
+            
+            if conditions:
+                query += " WHERE " + " AND ".join(conditions)
+            
             query += " ORDER BY created_at DESC"
             
+            if limit is not None:
+                query += " LIMIT %s OFFSET %s"
+                params.extend([limit, offset])
+            
             cur.execute(query, params)
             users = cur.fetchall()
     return [dict(u) for u in users]
@@ -1971,6 +2036,24 @@ def list_resources(section_id: str) -> List[Dict]:
             resources = cur.fetchall()
     return [dict(r) for r in resources]
 
+def list_resources_for_sections(section_ids: List[str]) -> List[Dict]:
+    """List resources across several sections in one query, shaped for the student resources view"""
+    if not section_ids:
+        return []
+    with get_db_connection() as conn:
+        with get_dict_cursor(conn) as cur:
+            cur.execute("""
+                SELECT r.id, r.title, '' as description, 'document' as type,
+                       r.url, r.file_path, '' as uploaded_by, '' as uploaded_date,
+                       NULL as size, r.section_id as course_id, s.name as course_name
+                FROM resources r
+                JOIN sections s ON r.section_id = s.id
+                WHERE r.section_id = ANY(%s)
+                ORDER BY s.created_at DESC, r.created_at DESC
+            """, (list(section_ids),))
+            resources = cur.fetchall()
+    return [dict(r) for r in resources]
+
 def delete_resource(resource_id: str):
     """Delete a resource"""
     with get_db_connection() as conn:
@@ -2083,6 +2166,31 @@ def get_assignment(assignment_id: str) -> Optional[Dict]:
 # INSTITUTION MANAGEMENT FUNCTIONS
 # ============================================
 
+# Institutions are read on most admin/auth requests but rarely change, so
+# lookups are cached in-process for a short TTL and invalidated on writes.
+INSTITUTION_CACHE_TTL = 60  # seconds
+_institution_cache: Dict[Any, tuple] = {}  # key -> (expires_at, value)
+_institution_cache_lock = threading.Lock()
+
+def _institution_cache_get(key):
+    with _institution_cache_lock:
+        entry = _institution_cache.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del _institution_cache[key]
+            return None
+        return entry[1]
+
+def _institution_cache_set(key, value):
+    with _institution_cache_lock:
+        _institution_cache[key] = (time.monotonic() + INSTITUTION_CACHE_TTL, value)
+
+def invalidate_institution_cache():
+    """Drop all cached institution lookups (call after any institution write)"""
+    with _institution_cache_lock:
+        _institution_cache.clear()
+
 def create_institution(name: str, code: str, domain: str = "", logo_url: str = "", 
                        contact_email: str = "") -> str:
     """Create a new institution"""
@@ -2093,15 +2201,25 @@ def create_institution(name: str, code: str, domain: str = "", logo_url: str = "
                 INSERT INTO institutions (id, name, code, domain, logo_url, contact_email)
                 VALUES (%s, %s, %s, %s, %s, %s)
             """, (institution_id, name, code, domain, logo_url, contact_email))
+    invalidate_institution_cache()
     return institution_id
 
 def get_institution(institution_id: str) -> Optional[Dict]:
-    """Get institution by ID"""
+    """Get institution by ID (cached for INSTITUTION_CACHE_TTL seconds)"""
+    key = ("institution", institution_id)
+    cached = _institution_cache_get(key)
+    if cached is not None:
+        return dict(cached)
+    
     with get_db_connection() as conn:
         with get_dict_cursor(conn) as cur:
             cur.execute("SELECT * FROM institutions WHERE id = %s", (institution_id,))
             institution = cur.fetchone()
-    return dict(institution) if institution else None
+    if not institution:
+        return None
+    institution = dict(institution)
+    _institution_cache_set(key, institution)
+    return dict(institution)
 
 def get_institution_by_domain(domain: str) -> Optional[Dict]:
     """Get institution by domain"""
@@ -2112,14 +2230,20 @@ def get_institution_by_domain(domain: str) -> Optional[Dict]:
     return dict(institution) if institution else None
 
 def list_institutions(active_only: bool = True) -> List[Dict]:
-    """List all institutions"""
+    """List all institutions (cached for INSTITUTION_CACHE_TTL seconds)"""
+    key = ("institutions", active_only)
+    cached = _institution_cache_get(key)
+    if cached is not None:
+        return [dict(i) for i in cached]
+    
     with get_db_connection() as conn:
         with get_dict_cursor(conn) as cur:
             if active_only:
                 cur.execute("SELECT * FROM institutions WHERE is_active = TRUE ORDER BY name ASC")
             else:
                 cur.execute("SELECT * FROM institutions ORDER BY name ASC")
-            institutions = cur.fetchall()
+            institutions = [dict(i) for i in cur.fetchall()]
+    _institution_cache_set(key, institutions)
     return [dict(i) for i in institutions]
 
 def update_institution(institution_id: str, **kwargs) -> bool:
@@ -2136,14 +2260,21 @@ def update_institution(institution_id: str, **kwargs) -> bool:
                 values.append(institution_id)
                 query = f"UPDATE institutions SET {', '.join(updates)}, updated_at = CURRENT_TIMESTAMP WHERE id = %s"
                 cur.execute(query, values)
-                return True
-    return False
+                updated = True
+            else:
+                updated = False
+    if updated:
+        invalidate_institution_cache()
+    return updated
+
+# Permissions granted when an admin assignment doesn't specify any
+DEFAULT_ADMIN_PERMISSIONS = ('manage_users', 'manage_courses', 'manage_assignments', 'view_analytics')
 
 def assign_admin_to_institution(user_id: str, institution_id: str, permissions: List[str] = None) -> str:
     """Assign an admin to an institution"""
     admin_id = str(uuid.uuid4())
     if permissions is None:
-        permissions = ['manage_users', 'manage_courses', 'manage_assignments', 'view_analytics']
+        permissions = list(DEFAULT_ADMIN_PERMISSIONS)
     
     with get_db_connection() as conn:
         with get_dict_cursor(conn) as cur:
@@ -2156,6 +2287,56 @@ def assign_admin_to_institution(user_id: str, institution_id: str, permissions:
             """, (admin_id, user_id, institution_id, permissions))
     return admin_id
 
+def assign_admins_bulk(institution_id: str, assignments: List[Dict]) -> Dict:
+    """
+    Assign several admins to an institution in one transaction.
+    `assignments` is a list of {'user_id': ..., 'permissions': [...] or None}.
+    Returns dict with 'assigned' ({user_id, admin_role_id} list) and 'skipped' list.
+    """
+    # Keep the first request per user (lists, since psycopg2 adapts tuples as records, not arrays)
+    requested = {}
+    for a in assignments:
+        requested.setdefault(a['user_id'], a.get('permissions') or list(DEFAULT_ADMIN_PERMISSIONS))
+    
+    skipped = []
+    assigned = []
+    if not requested:
+        return {"assigned": assigned, "skipped": skipped}
+    
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT id FROM users WHERE id = ANY(%s)", (list(requested),))
+            existing = {row[0] for row in cur.fetchall()}
+            for user_id in requested:
+                if user_id not in existing:
+                    skipped.append({"user_id": user_id, "reason": "User not found"})
+            
+            rows = [
+                (str(uuid.uuid4()), user_id, institution_id, permissions)
+                for user_id, permissions in requested.items() if user_id in existing
+            ]
+            if rows:
+                inserted = psycopg2.extras.execute_values(
+                    cur,
+                    """INSERT INTO institution_admins (id, user_id, institution_id, permissions)
+                       VALUES %s
+                       ON CONFLICT (user_id) DO NOTHING
+                       RETURNING id, user_id""",
+                    rows,
+                    fetch=True
+                )
+                assigned = [{"user_id": user_id, "admin_role_id": admin_id} for admin_id, user_id in inserted]
+                
+                assigned_ids = {a["user_id"] for a in assigned}
+                for _, user_id, _, _ in rows:
+                    if user_id not in assigned_ids:
+                        skipped.append({"user_id": user_id, "reason": "Already an institution admin"})
+                
+                if assigned_ids:
+                    cur.execute("UPDATE users SET role = %s WHERE id = ANY(%s)", ('admin', list(assigned_ids)))
+    
+    return {"assigned": assigned, "skipped": skipped}
+
 def get_user_institution(user_id: str) -> Optional[Dict]:
     """Get institution for a user"""
     with get_db_connection() as conn:
@@ -2193,6 +2374,57 @@ def get_institution_users(institution_id: str, role: str = None) -> List[Dict]:
             users = cur.fetchall()
     return [dict(u) for u in users]
 
+_USER_DETAIL_BUNDLE_QUERY = """
+    SELECT row_to_json(u) as user,
+           CASE WHEN i.id IS NULL THEN NULL ELSE row_to_json(i) END as institution,
+           CASE WHEN tp.id IS NULL THEN NULL ELSE row_to_json(tp) END as teacher_profile,
+           CASE WHEN sp.id IS NULL THEN NULL ELSE row_to_json(sp) END as student_profile
+    FROM users u
+    LEFT JOIN institutions i ON u.institution_id = i.id
+    LEFT JOIN teacher_profiles tp ON tp.user_id = u.id
+    LEFT JOIN student_profiles sp ON sp.user_id = u.id
+"""
+
+def _user_detail_from_row(row: Dict) -> Dict:
+    """Shape a bundle row as {user, profile, institution}, picking the profile for the user's role"""
+    user = row['user']
+    profile = None
+    if user['role'] == 'instructor':
+        profile = row['teacher_profile']
+    elif user['role'] == 'student':
+        profile = row['student_profile']
+    return {'user': user, 'profile': profile, 'institution': row['institution']}
+
+def get_user_detail_bundle(user_id: str) -> Optional[Dict]:
+    """Get a user with their role-specific profile and institution in a single query"""
+    with get_db_connection() as conn:
+        with get_dict_cursor(conn) as cur:
+            cur.execute(_USER_DETAIL_BUNDLE_QUERY + " WHERE u.id = %s", (user_id,))
+            row = cur.fetchone()
+    return _user_detail_from_row(row) if row else None
+
+def get_user_details_many(user_ids: List[str]) -> Dict[str, Dict]:
+    """Batch version of get_user_detail_bundle, keyed by user ID"""
+    if not user_ids:
+        return {}
+    with get_db_connection() as conn:
+        with get_dict_cursor(conn) as cur:
+            cur.execute(_USER_DETAIL_BUNDLE_QUERY + " WHERE u.id = ANY(%s)", (list(user_ids),))
+            rows = cur.fetchall()
+    return {row['user']['id']: _user_detail_from_row(row) for row in rows}
+
+def count_institution_users_by_role(institution_id: str) -> Dict[str, int]:
+    """Count users in an institution grouped by role, e.g. {'student': 120, 'instructor': 8}"""
+    with get_db_connection() as conn:
+        with get_dict_cursor(conn) as cur:
+            cur.execute("""
+                SELECT role, COUNT(*) as count FROM users
+                WHERE institution_id = %s
+                GROUP BY role
+            """, (institution_id,))
+            rows = cur.fetchall()
+    return {row['role']: row['count'] or 0 for row in rows}
+
 def is_super_admin(user_id: str) -> bool:
     """Check if user is a super admin"""
     with get_db_connection() as conn:
@@ -2216,8 +2448,59 @@ def is_institution_admin(user_id: str, institution_id: str) -> bool:
 # ANALYTICS & STUDENT MANAGEMENT FUNCTIONS
 # ============================================
 
+SYSTEM_ANALYTICS_MAX_AGE = 300  # seconds before mv_system_analytics is refreshed
+_system_analytics_refresh_lock = threading.Lock()
+_system_analytics_view_missing = False
+
 def get_system_analytics() -> Dict:
-    """Get system-wide analytics (Super Admin only)"""
+    """Get system-wide analytics (Super Admin only)
+    
+    Served from the mv_system_analytics snapshot, refreshed when older than
+    SYSTEM_ANALYTICS_MAX_AGE. Falls back to live aggregation on databases
+    created before the view was added to setup_postgres.sql.
+    """
+    global _system_analytics_view_missing
+    if _system_analytics_view_missing:
+        return _compute_system_analytics()
+    
+    try:
+        with get_db_connection() as conn:
+            with get_dict_cursor(conn) as cur:
+                row = _fetch_system_analytics_snapshot(cur)
+                # Only one thread per process refreshes; others serve the stale row
+                if row['age'] > SYSTEM_ANALYTICS_MAX_AGE and _system_analytics_refresh_lock.acquire(blocking=False):
+                    try:
+                        cur.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY mv_system_analytics")
+                        row = _fetch_system_analytics_snapshot(cur)
+                    finally:
+                        _system_analytics_refresh_lock.release()
+    except psycopg2.errors.UndefinedTable:
+        logger.warning("mv_system_analytics not found; computing system analytics live")
+        _system_analytics_view_missing = True
+        return _compute_system_analytics()
+    
+    return {
+        'total_institutions': row['total_institutions'],
+        'active_institutions': row['active_institutions'],
+        'total_users': row['total_users'],
+        'users_by_role': {
+            'super_admin': row['super_admin_count'],
+            'admin': row['admin_count'],
+            'instructor': row['instructor_count'],
+            'student': row['student_count']
+        },
+        'top_institutions': row['top_institutions']
+    }
+
+def _fetch_system_analytics_snapshot(cur) -> Dict:
+    cur.execute("""
+        SELECT *, EXTRACT(EPOCH FROM (NOW() - refreshed_at)) AS age
+        FROM mv_system_analytics
+    """)
+    return cur.fetchone()
+
+def _compute_system_analytics() -> Dict:
+    """Aggregate system-wide analytics directly from the base tables"""
     with get_db_connection() as conn:
         with get_dict_cursor(conn) as cur:
             # Count institutions
@@ -2259,48 +2542,34 @@ def get_system_analytics() -> Dict:
     }
 
 def get_institution_analytics(institution_id: str) -> Dict:
-    """Get detailed analytics for an institution"""
+    """Get detailed analytics for an institution (one round trip)"""
     with get_db_connection() as conn:
         with get_dict_cursor(conn) as cur:
-            # Get institution details
-            cur.execute("SELECT * FROM institutions WHERE id = %s", (institution_id,))
-            institution = cur.fetchone()
-            if not institution:
-                return {}
-            
-            # Count users by role
-            cur.execute("""
-                SELECT role, COUNT(*) as count FROM users 
-                WHERE institution_id = %s
-                GROUP BY role
-            """, (institution_id,))
-            users_by_role = {row['role']: row['count'] or 0 for row in cur.fetchall()}
-            
-            # Count active students
-            cur.execute("""
-                SELECT COUNT(*) as count FROM users 
-                WHERE institution_id = %s AND role = 'student'
-            """, (institution_id,))
-            total_students = cur.fetchone()['count'] or 0
-            
-            # Count courses
-            cur.execute("""
-                SELECT COUNT(*) as count FROM chatbots 
-                WHERE institution_id = %s
-            """, (institution_id,))
-            total_courses = cur.fetchone()['count'] or 0
-            
-            # Count pending assignments
+            # Institution row plus each aggregate as a scalar subquery, so
+            # Postgres evaluates them in one statement instead of 5 queries
             cur.execute("""
-                SELECT COUNT(*) as count FROM assignments 
-                WHERE chatbot_id IN (
-                    SELECT id FROM chatbots WHERE institution_id = %s
-                ) AND status = 'published'
+                SELECT i.*,
+                    (SELECT COALESCE(json_object_agg(r.role, r.count), '{}'::json)
+                     FROM (SELECT role, COUNT(*) AS count FROM users
+                           WHERE institution_id = i.id GROUP BY role) r) AS _users_by_role,
+                    (SELECT COUNT(*) FROM chatbots WHERE institution_id = i.id) AS _total_courses,
+                    (SELECT COUNT(*) FROM assignments a
+                     JOIN chatbots c ON a.chatbot_id = c.id
+                     WHERE c.institution_id = i.id AND a.status = 'published') AS _pending_assignments
+                FROM institutions i
+                WHERE i.id = %s
             """, (institution_id,))
-            pending_assignments = cur.fetchone()['count'] or 0
-            
+            row = cur.fetchone()
+            if not row:
+                return {}
+    
+    institution = dict(row)
+    users_by_role = institution.pop('_users_by_role')
+    total_courses = institution.pop('_total_courses') or 0
+    pending_assignments = institution.pop('_pending_assignments') or 0
+    
     return {
-        'institution': dict(institution),
+        'institution': institution,
         'students_count': users_by_role.get('student', 0),
         'teachers_count': users_by_role.get('instructor', 0),
         'admins_count': users_by_role.get('admin', 0),
@@ -2553,9 +2822,11 @@ def update_student_profile(user_id: str, **kwargs) -> bool:
                 return True
     return False
 
-# Initialize on import
-try:
-    init_db()
-    pass
-except Exception as e:
-    logger.warning(f"Database initialization skipped: {e}")
+# Initialize on import (not in multiprocessing children: PDF worker processes
+# re-import the main module and must not open database connections)
+if multiprocessing.parent_process() is None:
+    try:
+        init_db()
+        pass
+    except Exception as e:
+        logger.warning(f"Database initialization skipped: {e}")
@@ -1,3 +1,4 @@
+import asyncio
 import os
 import numpy as np
 from fastapi import APIRouter, HTTPException, Depends, UploadFile, File, Form, Body
@@ -184,13 +185,16 @@ async def get_class_admin(class_id: str, user=Depends(utils_auth.get_current_use
         if user.get("role") != "admin":
             raise HTTPException(status_code=403, detail="Only admins can view class details")
         
-        cls = db.get_class(class_id)
+        cls = await asyncio.to_thread(db.get_class, class_id)
         if not cls:
             raise HTTPException(status_code=404, detail="Class not found")
-        
-        cls["subjects"] = db.list_class_subjects(class_id)
-        cls["teacher_assignments"] = db.list_teacher_assignments(class_id)
-        cls["sections"] = db.get_sections_by_class(class_id)
+
+        # Independent lookups: run them concurrently on worker threads
+        cls["subjects"], cls["teacher_assignments"], cls["sections"] = await asyncio.gather(
+            asyncio.to_thread(db.list_class_subjects, class_id),
+            asyncio.to_thread(db.list_teacher_assignments, class_id),
+            asyncio.to_thread(db.get_sections_by_class, class_id),
+        )
         return cls
     except HTTPException:
         raise
@@ -502,8 +506,7 @@ async def get_available_students_admin(section_id: str, search: str = None, user
         
         # Get all students (filtered by institution)
         institution_id = user.get("institution_id")
-        all_users = db.list_users(institution_id)
-        students = [u for u in all_users if u.get("role") == "student"]
+        students = db.list_users(institution_id, role="student")
         
         # Get currently enrolled students
         enrollments = db.list_enrollments(section_id)
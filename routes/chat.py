@@ -1,11 +1,12 @@
 import os
+import re
 import uuid
 from typing import List, Optional, Dict, Any
 from fastapi import APIRouter, HTTPException, Form, Body
 from pydantic import BaseModel
 import database_postgres as db
 import vectorstore_postgres as vs
-from utils import build_system_user_prompt
+from utils import build_system_user_prompt, count_tokens, get_groq_client
 import logging
 from models import get_embed_model
 
@@ -22,6 +23,35 @@ class ChatRequest(BaseModel):
 # QUERY CLASSIFICATION
 # =============================================================================
 
+# Query-type keywords, each set compiled once into a case-insensitive
+# substring alternation
+
+# Structural queries: about book organization
+STRUCTURAL_KEYWORDS = (
+    "chapter", "unit", "table of contents", "toc", "topics", 
+    "syllabus", "index", "how many units", "how many chapters",
+    "what are the", "list all", "list the", "contents of"
+)
+
+# Exercise/problem queries
+EXERCISE_KEYWORDS = (
+    "question", "exercise", "problem", "solve", "quiz", 
+    "practice", "homework", "assignment"
+)
+
+# Definition queries
+DEFINITION_KEYWORDS = (
+    "what is", "define", "meaning of", "definition", 
+    "explain", "describe"
+)
+
+def _keyword_pattern(keywords) -> re.Pattern:
+    return re.compile("|".join(re.escape(k) for k in keywords), re.IGNORECASE)
+
+_STRUCTURAL_RE = _keyword_pattern(STRUCTURAL_KEYWORDS)
+_EXERCISE_RE = _keyword_pattern(EXERCISE_KEYWORDS)
+_DEFINITION_RE = _keyword_pattern(DEFINITION_KEYWORDS)
+
 def classify_query(question: str) -> Dict[str, Any]:
     """
     Classify the query type to optimize retrieval strategy.
@@ -29,28 +59,7 @@ def classify_query(question: str) -> Dict[str, Any]:
     Returns:
         Dict with: query_type, top_k, bm25_weight, faiss_weight
     """
-    q_lower = question.lower()
-    
-    # Structural queries: about book organization
-    structural_keywords = [
-        "chapter", "unit", "table of contents", "toc", "topics", 
-        "syllabus", "index", "how many units", "how many chapters",
-        "what are the", "list all", "list the", "contents of"
-    ]
-    
-    # Exercise/problem queries
-    exercise_keywords = [
-        "question", "exercise", "problem", "solve", "quiz", 
-        "practice", "homework", "assignment"
-    ]
-    
-    # Definition queries
-    definition_keywords = [
-        "what is", "define", "meaning of", "definition", 
-        "explain", "describe"
-    ]
-    
-    if any(k in q_lower for k in structural_keywords):
+    if _STRUCTURAL_RE.search(question):
         return {
             "query_type": "structural",
             "top_k": 15,
@@ -59,7 +68,7 @@ def classify_query(question: str) -> Dict[str, Any]:
             "fallback_bm25": 0.3,
             "fallback_faiss": 0.7
         }
-    elif any(k in q_lower for k in exercise_keywords):
+    elif _EXERCISE_RE.search(question):
         return {
             "query_type": "exercise",
             "top_k": 20,          # Fetch more for exercise listings
@@ -68,7 +77,7 @@ def classify_query(question: str) -> Dict[str, Any]:
             "fallback_bm25": 0.2,
             "fallback_faiss": 0.8
         }
-    elif any(k in q_lower for k in definition_keywords):
+    elif _DEFINITION_RE.search(question):
         return {
             "query_type": "definition",
             "top_k": 8,           # Definitions are usually concise
@@ -151,9 +160,6 @@ async def chat_endpoint(
     # Groq limit: 12K TPM. Budget: ~6K context + ~500 system prompt + 2K response + overhead
     MAX_CONTEXT_TOKENS = 6000
     
-    import tiktoken
-    enc = tiktoken.get_encoding("cl100k_base")
-    
     context_docs = []
     total_tokens = 0
     
@@ -164,7 +170,7 @@ async def chat_endpoint(
     
     for h in ordered_hits:
         text = h.get("text", "")
-        text_tokens = len(enc.encode(text))
+        text_tokens = count_tokens(text)
         
         if total_tokens + text_tokens > MAX_CONTEXT_TOKENS:
             logger.info(f"Context budget reached ({total_tokens} tokens). Skipping remaining {len(hits) - len(context_docs)} hits.")
@@ -245,9 +251,7 @@ def call_groq_llm(system_prompt: str, user_prompt: str) -> str:
         return "⚠️ GROQ_API_KEY not configured."
     
     try:
-        from groq import Groq
-        client = Groq(api_key=groq_api_key)
-        response = client.chat.completions.create(
+        response = get_groq_client(groq_api_key).chat.completions.create(
             model="llama-3.3-70b-versatile",
             messages=[
                 {"role": "system", "content": system_prompt},
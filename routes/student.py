@@ -1,6 +1,8 @@
 from typing import List, Dict, Any, Optional
 from fastapi import APIRouter, HTTPException, Depends, File, UploadFile, Form, Query
 from pydantic import BaseModel
+from datetime import datetime
+from collections import Counter
 import os
 import shutil
 import uuid
@@ -14,6 +16,64 @@ class SubmitQuizRequest(BaseModel):
     student_id: Optional[str] = None
     answers: Dict[str, str]
 
+# --- Response Models ---
+# Typed responses let FastAPI serialize through pydantic-core instead of
+# walking plain dicts with jsonable_encoder.
+
+class SectionSummary(BaseModel):
+    id: Optional[str] = None
+    display_id: Optional[str] = None
+    name: Optional[str] = None
+    section_id: Optional[str] = None
+    section_display_id: Optional[str] = None
+    section_name: Optional[str] = None
+    class_name: Optional[str] = None
+    class_display_id: Optional[str] = None
+    chatbot_id: Optional[str] = None
+    chatbot_display_id: Optional[str] = None
+    subject_name: Optional[str] = None
+    teacher_name: Optional[str] = None
+    teacher_display_id: Optional[str] = None
+    teacher_email: Optional[str] = None
+    created_at: Optional[datetime] = None
+    student_count: Optional[int] = None
+    attendance_percentage: float = 0
+    pending_assignments: int = 0
+
+class SectionsResponse(BaseModel):
+    sections: List[SectionSummary]
+    count: int
+
+class AttendanceStats(BaseModel):
+    total: int
+    present: int
+    absent: int
+    late: int
+    excused: int
+    percentage: float
+
+class AttendanceResponse(BaseModel):
+    section_id: str
+    records: List[Dict[str, Any]]
+    stats: AttendanceStats
+
+class CourseProgress(BaseModel):
+    course_id: Optional[str] = None
+    course_name: Optional[str] = None
+    total_assignments: int
+    completed_assignments: int
+    average_grade: float
+    completion_percentage: float
+    last_activity: Optional[Any] = None
+
+class ProgressSummary(BaseModel):
+    overall_completion: float
+    overall_average_grade: float
+    total_courses: int
+    total_assignments: int
+    completed_assignments: int
+    courses: List[CourseProgress]
+
 @router.get("/quizzes/{chatbot_id}")
 async def list_student_quizzes(chatbot_id: str, user=Depends(utils_auth.get_current_user)):
     """List published quizzes for students"""
@@ -234,7 +294,7 @@ async def get_my_submission(
 # COURSE MANAGEMENT: Student Views
 # ============================================
 
-@router.get("/sections")
+@router.get("/sections", response_model=SectionsResponse)
 async def list_my_sections(user=Depends(utils_auth.get_current_user)):
     """Get all sections student is enrolled in with enhanced information"""
     try:
@@ -387,7 +447,7 @@ async def get_section_overview(
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@router.get("/sections/{section_id}/attendance")
+@router.get("/sections/{section_id}/attendance", response_model=AttendanceResponse)
 async def get_my_attendance(section_id: str, chatbot_id: Optional[str] = None, user=Depends(utils_auth.get_current_user)):
     """Get personal attendance record for a section"""
     try:
@@ -399,10 +459,11 @@ async def get_my_attendance(section_id: str, chatbot_id: Optional[str] = None, u
         
         # Calculate stats
         total = len(attendance)
-        present = sum(1 for a in attendance if a["status"] == "present")
-        absent = sum(1 for a in attendance if a["status"] == "absent")
-        late = sum(1 for a in attendance if a["status"] == "late")
-        excused = sum(1 for a in attendance if a["status"] == "excused")
+        status_counts = Counter(a["status"] for a in attendance)
+        present = status_counts["present"]
+        absent = status_counts["absent"]
+        late = status_counts["late"]
+        excused = status_counts["excused"]
         
         return {
             "section_id": section_id,
@@ -728,7 +789,7 @@ async def get_student_grades(user=Depends(utils_auth.get_current_user)):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error loading grades: {str(e)}")
 
-@router.get("/progress")
+@router.get("/progress", response_model=ProgressSummary)
 async def get_student_progress(user=Depends(utils_auth.get_current_user)):
     """Get overall progress analytics"""
     try:
@@ -837,28 +898,9 @@ async def get_course_resources(user=Depends(utils_auth.get_current_user)):
     try:
         student_id = user.get("sub") or user.get("id")
         
-        # Get enrolled sections
+        # Get enrolled sections, then fetch all their resources in one query
         enrollments = db.get_student_enrollments(student_id)
-        all_resources = []
-        
-        for enrollment in enrollments:
-            section_id = enrollment.get("section_id")
-            resources = db.list_resources(section_id) if hasattr(db, 'list_resources') else []
-            
-            for res in resources:
-                all_resources.append({
-                    "id": res.get("id"),
-                    "title": res.get("title"),
-                    "description": res.get("description", ""),
-                    "type": res.get("type", "document"),  # document, video, link, assignment
-                    "url": res.get("url"),
-                    "file_path": res.get("file_path"),
-                    "uploaded_by": res.get("uploaded_by", ""),
-                    "uploaded_date": res.get("uploaded_date", ""),
-                    "size": res.get("size"),
-                    "course_id": section_id,
-                    "course_name": enrollment.get("section_name", "")
-                })
+        all_resources = db.list_resources_for_sections([e["section_id"] for e in enrollments])
         
         return {"resources": all_resources}
     except Exception as e:
@@ -1,4 +1,4 @@
-from fastapi import APIRouter, HTTPException, Depends, status
+from fastapi import APIRouter, HTTPException, Depends, Query, status
 from pydantic import BaseModel
 from typing import List, Optional
 import database_postgres as db
@@ -7,6 +7,12 @@ from datetime import datetime
 
 router = APIRouter(prefix="/super_admin", tags=["Super Admin"])
 
+USER_ROLES = ('super_admin', 'admin', 'instructor', 'student')
+VALID_ROLES = frozenset(USER_ROLES)
+
+# Handlers are plain `def` on purpose: the db layer is synchronous psycopg2,
+# so FastAPI runs them on its threadpool instead of blocking the event loop.
+
 # ============================================
 # REQUEST/RESPONSE MODELS
 # ============================================
@@ -27,7 +33,7 @@ class AssignAdminRequest(BaseModel):
 # DEPENDENCY: Check if user is super admin
 # ============================================
 
-async def check_super_admin(user_data = Depends(utils_auth.get_current_user)):
+def check_super_admin(user_data = Depends(utils_auth.get_current_user)):
     """Verify that the current user is a super admin"""
     if not db.is_super_admin(user_data.get("sub")):
         raise HTTPException(
@@ -41,7 +47,7 @@ async def check_super_admin(user_data = Depends(utils_auth.get_current_user)):
 # ============================================
 
 @router.get("/institutions")
-async def list_institutions(user_data = Depends(check_super_admin)):
+def list_institutions(user_data = Depends(check_super_admin)):
     """Get all institutions (Super Admin only)"""
     institutions = db.list_institutions(active_only=False)
     return {
@@ -51,29 +57,27 @@ async def list_institutions(user_data = Depends(check_super_admin)):
     }
 
 @router.get("/institutions/{institution_id}")
-async def get_institution(institution_id: str, user_data = Depends(check_super_admin)):
+def get_institution(institution_id: str, user_data = Depends(check_super_admin)):
     """Get institution details (Super Admin only)"""
     institution = db.get_institution(institution_id)
     if not institution:
         raise HTTPException(status_code=404, detail="Institution not found")
     
-    # Get institution statistics
-    users = db.get_institution_users(institution_id)
-    students = [u for u in users if u['role'] == 'student']
-    teachers = [u for u in users if u['role'] == 'instructor']
+    # Get institution statistics (counted in SQL, one row per role)
+    users_by_role = db.count_institution_users_by_role(institution_id)
     
     return {
         "institution": institution,
         "statistics": {
-            "total_users": len(users),
-            "total_students": len(students),
-            "total_teachers": len(teachers),
-            "total_admins": len([u for u in users if u['role'] == 'admin'])
+            "total_users": sum(users_by_role.values()),
+            "total_students": users_by_role.get('student', 0),
+            "total_teachers": users_by_role.get('instructor', 0),
+            "total_admins": users_by_role.get('admin', 0)
         }
     }
 
 @router.post("/institutions")
-async def create_institution(
+def create_institution(
     inst_request: InstitutionRequest,
     user_data = Depends(check_super_admin)
 ):
@@ -102,7 +106,7 @@ async def create_institution(
         raise HTTPException(status_code=500, detail=f"Failed to create institution: {str(e)}")
 
 @router.put("/institutions/{institution_id}")
-async def update_institution(
+def update_institution(
     institution_id: str,
     inst_request: InstitutionRequest,
     user_data = Depends(check_super_admin)
@@ -138,7 +142,7 @@ async def update_institution(
 # ============================================
 
 @router.post("/institutions/{institution_id}/assign-admin")
-async def assign_admin_to_institution(
+def assign_admin_to_institution(
     institution_id: str,
     assign_request: AssignAdminRequest,
     user_data = Depends(check_super_admin)
@@ -156,9 +160,7 @@ async def assign_admin_to_institution(
         raise HTTPException(status_code=404, detail="User not found")
     
     try:
-        permissions = assign_request.permissions or [
-            'manage_users', 'manage_courses', 'manage_assignments', 'view_analytics'
-        ]
+        permissions = assign_request.permissions or list(db.DEFAULT_ADMIN_PERMISSIONS)
         
         admin_role_id = db.assign_admin_to_institution(
             user_id=assign_request.user_id,
@@ -176,31 +178,60 @@ async def assign_admin_to_institution(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to assign admin: {str(e)}")
 
+@router.post("/institutions/{institution_id}/assign-admins")
+def assign_admins_to_institution(
+    institution_id: str,
+    assign_requests: List[AssignAdminRequest],
+    user_data = Depends(check_super_admin)
+):
+    """Assign several admins to an institution in one batch (Super Admin only)"""
+    
+    # Verify institution exists
+    institution = db.get_institution(institution_id)
+    if not institution:
+        raise HTTPException(status_code=404, detail="Institution not found")
+    
+    if not assign_requests:
+        raise HTTPException(status_code=400, detail="No admins provided")
+    
+    try:
+        result = db.assign_admins_bulk(
+            institution_id,
+            [{"user_id": r.user_id, "permissions": r.permissions} for r in assign_requests]
+        )
+        return {
+            "message": f"Assigned {len(result['assigned'])} admin(s) to institution",
+            "institution_id": institution_id,
+            "assigned": result["assigned"],
+            "skipped": result["skipped"]
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to assign admins: {str(e)}")
+
 # ============================================
 # USER MANAGEMENT ENDPOINTS
 # ============================================
 
 @router.get("/users")
-async def list_all_users(
+def list_all_users(
     role: Optional[str] = None,
     institution_id: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    offset: int = Query(0, ge=0),
     user_data = Depends(check_super_admin)
 ):
     """List all users across all institutions (Super Admin only)"""
     
-    users = db.list_users()
-    
-    # Filter by role if specified
-    if role:
-        users = [u for u in users if u.get('role') == role]
-    
-    # Filter by institution if specified
-    if institution_id:
-        users = [u for u in users if u.get('institution_id') == institution_id]
+    # Role / institution filters and paging are applied in SQL, so large
+    # institutions can be fetched and serialized one page at a time
+    users = db.list_users(institution_id=institution_id, role=role,
+                          limit=limit, offset=offset)
     
     return {
         "message": "Users retrieved successfully",
         "count": len(users),
+        "limit": limit,
+        "offset": offset,
         "filters": {
             "role": role,
             "institution_id": institution_id
@@ -209,45 +240,33 @@ async def list_all_users(
     }
 
 @router.get("/users/{user_id}")
-async def get_user_details(
+def get_user_details(
     user_id: str,
     user_data = Depends(check_super_admin)
 ):
     """Get detailed user information (Super Admin only)"""
     
-    user = db.get_user_by_id(user_id)
-    if not user:
+    # User, role-specific profile and institution come back from one query
+    details = db.get_user_detail_bundle(user_id)
+    if not details:
         raise HTTPException(status_code=404, detail="User not found")
     
-    # Get role-specific profile data
-    profile_data = None
-    if user['role'] == 'instructor':
-        profile_data = db.get_teacher_profile(user_id)
-    elif user['role'] == 'student':
-        profile_data = db.get_student_profile(user_id)
-    
-    # Get institution details if applicable
-    institution = None
-    if user.get('institution_id'):
-        institution = db.get_institution(user['institution_id'])
-    
     return {
-        "user": user,
-        "profile": profile_data,
-        "institution": institution
+        "user": details["user"],
+        "profile": details["profile"],
+        "institution": details["institution"]
     }
 
 @router.post("/users/{user_id}/change-role")
-async def change_user_role(
+def change_user_role(
     user_id: str,
     new_role: str,
     user_data = Depends(check_super_admin)
 ):
     """Change a user's role (Super Admin only)"""
     
-    valid_roles = ['super_admin', 'admin', 'instructor', 'student']
-    if new_role not in valid_roles:
-        raise HTTPException(status_code=400, detail=f"Invalid role. Must be one of: {valid_roles}")
+    if new_role not in VALID_ROLES:
+        raise HTTPException(status_code=400, detail=f"Invalid role. Must be one of: {list(USER_ROLES)}")
     
     # Verify user exists
     user = db.get_user_by_id(user_id)
@@ -270,7 +289,7 @@ async def change_user_role(
 # ============================================
 
 @router.get("/analytics/overview")
-async def get_analytics_overview(user_data = Depends(check_super_admin)):
+def get_analytics_overview(user_data = Depends(check_super_admin)):
     """Get system-wide analytics overview (Super Admin only)"""
     
     analytics = db.get_system_analytics()
@@ -286,7 +305,7 @@ async def get_analytics_overview(user_data = Depends(check_super_admin)):
     }
 
 @router.get("/analytics/institutions/{institution_id}")
-async def get_institution_analytics(
+def get_institution_analytics(
     institution_id: str,
     user_data = Depends(check_super_admin)
 ):
@@ -313,7 +332,7 @@ async def get_institution_analytics(
 # ============================================
 
 @router.get("/students")
-async def list_all_students(
+def list_all_students(
     search: Optional[str] = None,
     institution_id: Optional[str] = None,
     limit: int = 50,
@@ -342,7 +361,7 @@ async def list_all_students(
     }
 
 @router.get("/students/{student_id}")
-async def get_student_profile(
+def get_student_profile(
     student_id: str,
     user_data = Depends(check_super_admin)
 ):
@@ -360,7 +379,7 @@ async def get_student_profile(
     }
 
 @router.get("/institutions/{institution_id}/students")
-async def list_institution_students(
+def list_institution_students(
     institution_id: str,
     search: Optional[str] = None,
     department: Optional[str] = None,
@@ -618,6 +618,43 @@ ALTER TABLE assignments
 ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP DEFAULT NULL;
 CREATE INDEX IF NOT EXISTS idx_assignments_deleted ON assignments(deleted_at);
 -- ============================================
+-- QUERY PERFORMANCE INDEXES
+-- ============================================
+-- User/student listings filtered by role and institution, newest first
+-- (super admin / admin views, list_institution_students pagination)
+CREATE INDEX IF NOT EXISTS idx_users_role_inst_created ON users(role, institution_id, created_at DESC);
+-- Substring search (ILIKE '%term%') on student/user listings
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX IF NOT EXISTS idx_users_search_trgm ON users
+    USING gin (full_name gin_trgm_ops, email gin_trgm_ops, username gin_trgm_ops);
+-- Department filter on student listings
+CREATE INDEX IF NOT EXISTS idx_student_inst_dept ON student_profiles(institution_id, department);
+-- ============================================
+-- SYSTEM ANALYTICS SNAPSHOT
+-- ============================================
+-- Pre-aggregated super admin overview. Refreshed by the API when older than
+-- SYSTEM_ANALYTICS_MAX_AGE (REFRESH MATERIALIZED VIEW CONCURRENTLY).
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_system_analytics AS
+SELECT 1 AS id,
+    (SELECT COUNT(*) FROM institutions) AS total_institutions,
+    (SELECT COUNT(*) FROM institutions WHERE is_active = TRUE) AS active_institutions,
+    (SELECT COUNT(*) FROM users WHERE role = 'super_admin') AS super_admin_count,
+    (SELECT COUNT(*) FROM users WHERE role = 'admin') AS admin_count,
+    (SELECT COUNT(*) FROM users WHERE role = 'instructor') AS instructor_count,
+    (SELECT COUNT(*) FROM users WHERE role = 'student') AS student_count,
+    (SELECT COUNT(*) FROM users) AS total_users,
+    (SELECT COALESCE(json_agg(t), '[]'::json) FROM (
+        SELECT i.name, COUNT(u.id) AS student_count
+        FROM institutions i
+        LEFT JOIN users u ON i.id = u.institution_id AND u.role = 'student'
+        GROUP BY i.id, i.name
+        ORDER BY student_count DESC
+        LIMIT 5
+    ) t) AS top_institutions,
+    NOW() AS refreshed_at;
+-- CONCURRENTLY refresh requires a unique index
+CREATE UNIQUE INDEX IF NOT EXISTS idx_mv_system_analytics_id ON mv_system_analytics(id);
+-- ============================================
 -- INITIALIZATION COMPLETE
 -- ============================================
 -- Print success message
@@ -0,0 +1,61 @@
+import psycopg2
+
+import database_postgres as db
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query):
+        if self.conn.dropped:
+            # What psycopg2 does on a connection the server has gone away from
+            self.conn.closed = 2
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+
+
+class FakeConn:
+    def __init__(self, dropped=False):
+        self.dropped = dropped
+        self.closed = 0
+        self.committed = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        pass
+
+    def commit(self):
+        self.committed = True
+
+
+class FakePool:
+    def __init__(self, idle):
+        self.idle = list(idle)
+        self.returned = []
+
+    def getconn(self):
+        return self.idle.pop(0) if self.idle else FakeConn()
+
+    def putconn(self, conn, close=False):
+        self.returned.append((conn, close))
+
+
+def test_get_db_connection_discards_connections_dropped_by_the_server(monkeypatch):
+    dead = [FakeConn(dropped=True), FakeConn(dropped=True)]
+    live = FakeConn()
+    pool = FakePool(dead + [live])
+    monkeypatch.setattr(db, "_get_pool", lambda: pool)
+
+    with db.get_db_connection() as conn:
+        assert conn is live
+
+    assert live.committed
+    assert pool.returned == [(dead[0], True), (dead[1], True), (live, False)]
@@ -0,0 +1,304 @@
+import sys
+
+import fitz
+import pytest
+
+import utils
+
+
+DEVANAGARI_TEXT = (
+    "विज्ञान र प्रविधि हाम्रो दैनिक जीवनको अभिन्न अङ्ग बनेको छ। "
+    "पाठ १: पदार्थको अवस्था — ठोस, तरल र ग्यास। "
+    "Photosynthesis converts light energy into chemical energy. "
+    "एकाइ २: ऊर्जा र यसका स्रोतहरू, सौर्य ऊर्जा, जलविद्युत्। "
+) * 60
+
+
+def _char_offset_of_byte(text, byte_offset):
+    # Index of the character that contains `byte_offset` (a split character counts as started)
+    return len(text.encode("utf-8")[:byte_offset].decode("utf-8", errors="ignore"))
+
+
+def test_window_char_starts_exact_for_multibyte_text():
+    enc = utils.get_tokenizer()
+    tokens = enc.encode_ordinary(DEVANAGARI_TEXT)
+    chunk_size, overlap = 50, 10
+    step = chunk_size - overlap
+    windows = utils._split_tokens(tokens, chunk_size, overlap)
+    assert len(windows) > 20
+
+    starts = utils._window_char_starts(DEVANAGARI_TEXT, tokens, len(windows), step)
+
+    assert len(starts) == len(windows)
+    checked = 0
+    for k, (start, window) in enumerate(zip(starts, windows)):
+        byte_start = len(enc.decode_bytes(tokens[:k * step]))
+        assert start == _char_offset_of_byte(DEVANAGARI_TEXT, byte_start)
+        chunk_text = enc.decode(window)
+        if "�" not in chunk_text:
+            # The window starts on a character boundary: its text is found right there
+            assert DEVANAGARI_TEXT.find(chunk_text, start) == start
+            checked += 1
+    assert checked > 0
+
+
+def test_window_char_starts_ascii_matches_find():
+    text = " ".join(f"word{i}" for i in range(2000))
+    enc = utils.get_tokenizer()
+    tokens = enc.encode_ordinary(text)
+    windows = utils._split_tokens(tokens)
+    starts = utils._window_char_starts(text, tokens, len(windows))
+
+    for start, chunk_text in zip(starts, enc.decode_batch(windows)):
+        assert text.find(chunk_text) == start
+
+
+def test_front_matter_toc_cues_include_devanagari():
+    preface = "यो पुस्तक विद्यार्थीहरूका लागि तयार गरिएको हो। हामी सबैलाई धन्यवाद दिन्छौं।"
+    nepali_toc = "विषयसूची\nएकाइ १ सङ्ख्या प्रणाली ... १\nएकाइ २ बीजगणित ... १५"
+
+    assert not utils.front_matter_may_have_toc(None, page_texts=[preface])
+    assert utils.front_matter_may_have_toc(None, page_texts=[preface, nepali_toc])
+    assert utils.front_matter_may_have_toc(None, page_texts=[preface, "अध्याय ३: ज्यामिति"])
+
+
+def test_front_matter_without_toc_cues_skips_model_tiers():
+    pages = ["Preface\nThis book was written for students.", "Acknowledgements\nWe thank everyone."]
+
+    assert not utils.front_matter_may_have_toc(None, page_texts=pages)
+    # A page without a text layer can't be judged, so the model tiers still run
+    assert utils.front_matter_may_have_toc(None, page_texts=pages + [""])
+
+
+def test_groq_prompt_keeps_devanagari_toc_pages_past_the_title_pages():
+    texts = [
+        "गणित\nकक्षा ९",
+        "",
+        "प्रकाशक: पाठ्यक्रम विकास केन्द्र",
+        "यो पुस्तक विद्यार्थीहरूका लागि तयार गरिएको हो।",
+        "विषयसूची\nएकाइ १ सङ्ख्या प्रणाली १\nएकाइ २ बीजगणित १५",
+        "Contents\nUnit 3 Geometry 30",
+    ]
+
+    prompt = utils._groq_toc_prompt_pages(texts)
+
+    assert "--- PAGE 1 ---" in prompt and "--- PAGE 3 ---" in prompt
+    assert "--- PAGE 2 ---" not in prompt  # no text
+    assert "--- PAGE 4 ---" not in prompt  # preface without cues
+    assert "--- PAGE 5 ---\nविषयसूची" in prompt
+    assert "--- PAGE 6 ---\nContents" in prompt
+
+
+# Multi-column TOC layouts; expected maps are what the original (pre-single-sweep) parser returned
+
+def test_multicolumn_toc_two_column_table():
+    pages = [
+        "English\nGrade 9",
+        "Contents\nUnit\nTopic\nReading\nGrammar\nPage\n"
+        "1\nTravel and holidays\nA trip to Pokhara\nPresent simple\n1\n"
+        "2\nFood and health\nA healthy meal\nPast simple\n13\n"
+        "3\nScience and technology\nRobots at work\nPassive voice\n27",
+        "Preface\nThis book follows the new curriculum.",
+    ]
+
+    assert utils._parse_multicolumn_toc(None, len(pages), pages) == {
+        1: "Unit 1: Travel and holidays",
+        13: "Unit 2: Food and health",
+        27: "Unit 3: Science and technology",
+    }
+
+
+def test_multicolumn_toc_interleaved_columns_and_continuation_page():
+    pages = [
+        "Table of Contents\nUnit\nTopic\nSpeaking\nWriting\nPage\n"
+        "1\nFamily\n10\n12\n6\n"
+        "2\nOur environment\n14\n16\n20\n"
+        "3\nGames and sports\n18\n22\n34",
+        # Continuation page: no heading, only more table rows
+        "4\nArts and culture\n24\n26\n48\n"
+        "5\nHealth\n28\n30\n61",
+        "Unit 1 Family\nRead the text and answer the questions.",
+    ]
+
+    assert utils._parse_multicolumn_toc(None, len(pages), pages) == {
+        6: "Unit 1: Family",
+        20: "Unit 2: Our environment",
+        34: "Unit 3: Games and sports",
+        48: "Unit 4: Arts and culture",
+        61: "Unit 5: Health",
+    }
+
+
+def test_multicolumn_toc_bare_numbers():
+    pages = [
+        "Contents\n1\nSets\n5\n2\nAlgebra\n19\n3\nGeometry\n34\n4\nStatistics\n52",
+        "Preface\nMathematics is everywhere.",
+    ]
+
+    assert utils._parse_multicolumn_toc(None, len(pages), pages) == {
+        5: "Unit 1: Sets",
+        19: "Unit 2: Algebra",
+        34: "Unit 3: Geometry",
+        52: "Unit 4: Statistics",
+    }
+
+
+def test_text_toc_continues_after_interrupting_pages():
+    toc_start = "Contents\nUnit 1\nNumber system\n1\nUnit 2\nAlgebra\n15\nUnit 3\nGeometry\n30"
+    toc_rest = "Contents (continued)\nUnit 4\nStatistics\n45\nUnit 5\nProbability\n60"
+    pages = [
+        "Mathematics\nGrade 10",
+        toc_start,
+        "Preface\nThis book follows the national curriculum.",
+        "Foreword\nWe thank the teachers who reviewed it.",
+        "Acknowledgements\nPhotographs courtesy of the authors.",
+        toc_rest,
+        "Unit 1 Number system\nNatural numbers are counting numbers.",
+    ]
+
+    toc_map = utils.extract_toc_from_text(pages, pages)
+
+    assert toc_map == {
+        1: "Unit 1: Number system",
+        15: "Unit 2: Algebra",
+        30: "Unit 3: Geometry",
+        45: "Unit 4: Statistics",
+        60: "Unit 5: Probability",
+    }
+
+
+def _reference_windows(tokens, chunk_size, overlap):
+    # The original while-loop chunker: advance by chunk_size - overlap until a window reaches the end
+    windows = []
+    start = 0
+    while start < len(tokens):
+        end = min(start + chunk_size, len(tokens))
+        windows.append(tokens[start:end])
+        if end == len(tokens):
+            break
+        start += chunk_size - overlap
+    return windows
+
+
+def test_split_tokens_window_boundaries():
+    size, overlap = utils.CHUNK_SIZE, utils.CHUNK_OVERLAP
+    step = size - overlap
+    lengths = [
+        0,
+        1,
+        size - 1,  # shorter than one window
+        size,  # exactly one window
+        size + 1,
+        size + step,  # windows end exactly at the last token
+        size + 3 * step,
+        size + step + overlap // 2,  # remainder smaller than the overlap
+        size + step + overlap,
+        size + step + overlap + 1,
+    ]
+    for n in lengths:
+        tokens = list(range(n))
+        windows = utils._split_tokens(tokens)
+
+        assert windows == _reference_windows(tokens, size, overlap), n
+        assert all(len(w) <= size for w in windows)
+        if tokens:
+            assert windows[-1][-1] == tokens[-1]
+
+
+def test_split_tokens_exact_multiple_has_no_trailing_overlap_window():
+    tokens = list(range(600 + 2 * 500))
+
+    windows = utils._split_tokens(tokens, chunk_size=600, overlap=100)
+
+    assert [(w[0], len(w)) for w in windows] == [(0, 600), (500, 600), (1000, 600)]
+
+
+def test_split_tokens_rejects_overlap_not_smaller_than_chunk_size():
+    with pytest.raises(ValueError):
+        utils._split_tokens(list(range(10)), chunk_size=5, overlap=5)
+
+
+def _text_pdf(pages):
+    doc = fitz.open()
+    for text in pages:
+        doc.new_page().insert_textbox(fitz.Rect(36, 36, 560, 800), text, fontsize=9)
+    pdf_bytes = doc.tobytes()
+    doc.close()
+    return pdf_bytes
+
+
+def test_unconfigured_toc_backends_are_not_failures(monkeypatch):
+    monkeypatch.delenv("GROQ_API_KEY", raising=False)
+    monkeypatch.setitem(sys.modules, "docling", None)  # import fails like an absent package
+    failures = []
+
+    assert utils.extract_toc_with_docling(None, [], failures) == {}
+    assert utils.extract_toc_with_groq(None, [], failures) == {}
+    assert failures == []
+
+
+def test_process_pdf_caches_when_model_tiers_are_unavailable(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "PDF_CHUNK_CACHE_DIR", str(tmp_path))
+    monkeypatch.delenv("GROQ_API_KEY", raising=False)
+    monkeypatch.setitem(sys.modules, "docling", None)
+    body = "Photosynthesis converts light energy into chemical energy in green plants. " * 30
+    # The "Contents" cue sends the book through the Docling/Groq tiers
+    pdf_bytes = _text_pdf(["Contents\nIntroduction and overview"] + [body] * 3)
+
+    chunks = utils.process_pdf(pdf_bytes)
+
+    assert chunks
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+def test_process_pdf_skips_cache_write_for_degraded_runs(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, "PDF_CHUNK_CACHE_DIR", str(tmp_path))
+    chunks = [{"text": "x", "page": 1, "chapter": "Unknown", "section_type": "content", "token_count": 1}]
+    failures = []
+    calls = []
+
+    def fake_uncached(pdf_bytes):
+        calls.append(pdf_bytes)
+        return chunks, list(failures)
+
+    monkeypatch.setattr(utils, "_process_pdf_uncached", fake_uncached)
+
+    failures.append("ocr: page 3")
+    assert utils.process_pdf(b"degraded") == chunks
+    assert utils.process_pdf(b"degraded") == chunks
+    assert len(calls) == 2  # nothing stored, so the second upload is processed again
+    assert list(tmp_path.iterdir()) == []
+
+    failures.clear()
+    assert utils.process_pdf(b"clean") == chunks
+    assert utils.process_pdf(b"clean") == chunks
+    assert len(calls) == 3  # second upload served from the cache
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+def test_toc_is_reused_for_a_reingested_pdf(monkeypatch):
+    monkeypatch.setattr(utils, "PDF_CHUNK_CACHE_DIR", "")
+    monkeypatch.setattr(utils, "_TOC_CACHE", utils.OrderedDict())
+    tier_failures = []
+    calls = []
+
+    def fake_best_toc(doc, failures):
+        calls.append(len(doc))
+        failures.extend(tier_failures)
+        return {1: "Unit 1: Light"}
+
+    monkeypatch.setattr(utils, "_extract_best_toc", fake_best_toc)
+    body = "Light travels in straight lines and reflects from smooth surfaces. " * 30
+    book = _text_pdf([body] * 2)
+    other_book = _text_pdf([body] * 3)
+
+    utils.process_pdf(book)
+    chunks = utils.process_pdf(book)
+    assert calls == [2]
+    assert chunks[0]["section_type"] == "toc"
+
+    # A run where a tier errored is not remembered
+    tier_failures.append("groq: timeout")
+    utils.process_pdf(other_book)
+    utils.process_pdf(other_book)
+    assert calls == [2, 3, 3]
@@ -1,29 +1,155 @@
+import bisect
+import hashlib
 import io
 import logging
+import multiprocessing
 import os
+import queue
 import re
 import json
+import subprocess
+import threading
+import time
+from collections import Counter, OrderedDict
+from functools import lru_cache
+from itertools import accumulate
+from operator import itemgetter
 from typing import List, Dict, Tuple, Optional
 import fitz  # PyMuPDF
+import numpy as np
 import tiktoken
 import pytesseract
-from concurrent.futures import ThreadPoolExecutor
-from pdf2image import convert_from_bytes
-from PIL import Image
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("rag-utils")
 
+# Damaged textbook PDFs can make MuPDF print an error line per page; keep those
+# in its warnings store (fitz.TOOLS.mupdf_warnings()) instead of spamming stderr
+fitz.TOOLS.mupdf_display_errors(False)
+
 # Constants
 CHUNK_SIZE = 600  # Smaller chunks for better granularity
 CHUNK_OVERLAP = 100  # Moderate overlap for context continuity
+# Render resolution for OCR; 110-130 is often enough for Tesseract on clean scans
+OCR_DPI = int(os.getenv("OCR_DPI", "150"))
+OCR_MAX_WORKERS = 8
+OCR_PAGES_PER_TASK = 4  # scanned pages sent to an OCR worker process at a time
+# Text-layer extraction moves to worker processes for books at least this long
+TEXT_EXTRACT_PARALLEL_MIN_PAGES = 200
+TEXT_EXTRACT_WORKERS = min(8, os.cpu_count() or 1)
+# Processed chunks are cached on disk by PDF content hash; bump the version
+# whenever a change to process_pdf alters its output.
+PDF_CHUNK_CACHE_DIR = os.getenv("PDF_CHUNK_CACHE_DIR", os.path.join("uploads", "pdf_chunk_cache"))
+PDF_CHUNK_CACHE_VERSION = 11
+# Cache entries older than this (seconds) are treated as misses and pruned
+PDF_CHUNK_CACHE_TTL = int(os.getenv("PDF_CHUNK_CACHE_TTL", "86400"))
+# "tesseract" (default, CPU) or "paddle" (PaddleOCR, uses the GPU when available)
+OCR_BACKEND = os.getenv("OCR_BACKEND", "tesseract").lower()
+
+_PADDLE_OCR = None
+_PADDLE_LOCK = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def _warn_once(message: str):
+    """Log a missing optional backend or API key once per process instead of on every PDF"""
+    logger.warning(message)
+
+
+def get_paddle_ocr():
+    """Lazily load a single shared PaddleOCR model. Returns None if PaddleOCR is not installed."""
+    global _PADDLE_OCR
+    with _PADDLE_LOCK:
+        if _PADDLE_OCR is None:
+            try:
+                from paddleocr import PaddleOCR
+            except ImportError:
+                logger.warning("PaddleOCR not installed. Falling back to Tesseract OCR.")
+                return None
+            logger.info("Loading PaddleOCR model...")
+            _PADDLE_OCR = PaddleOCR(lang="en", use_angle_cls=False, show_log=False)
+    return _PADDLE_OCR
+
+
+def paddle_image_to_string(ocr, pix) -> str:
+    """OCR a PyMuPDF pixmap with PaddleOCR and return its text lines joined by newlines"""
+    # samples_mv is a view of MuPDF's buffer (pix.samples would copy it first)
+    img = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+    result = ocr.ocr(img[:, :, 2::-1], cls=False)  # PaddleOCR expects BGR
+    if not result or not result[0]:
+        return ""
+    return "\n".join(line[1][0] for line in result[0])
+
+
+# Idle in-process Tesseract engines (tesserocr), reused across pages and PDFs.
+# Each one holds loaded traineddata, so OCR no longer forks a tesseract process per page.
+_TESSEROCR_APIS = queue.SimpleQueue()
+_TESSEROCR_AVAILABLE = None  # probed on the first OCR call
+_tesserocr = None  # the tesserocr module, when the probe found it
+
+
+def tesseract_pixmap_to_string(pix: fitz.Pixmap) -> str:
+    """
+    OCR a grayscale/RGB PyMuPDF pixmap with Tesseract.
+    
+    With tesserocr installed the raw samples go straight into a resident
+    engine (no PIL image, no temp file, no subprocess). Otherwise the pixmap is
+    piped as PNM into the tesseract binary's stdin, skipping the PIL copy and
+    the temp image file pytesseract would write.
+    """
+    global _TESSEROCR_AVAILABLE, _tesserocr
+    if _TESSEROCR_AVAILABLE is None:
+        try:
+            import tesserocr
+            _tesserocr = tesserocr
+            _TESSEROCR_AVAILABLE = True
+        except ImportError:
+            _TESSEROCR_AVAILABLE = False
+    if not _TESSEROCR_AVAILABLE:
+        try:
+            proc = subprocess.run(
+                [pytesseract.pytesseract.tesseract_cmd, "stdin", "stdout"],
+                input=pix.tobytes("pnm"),
+                capture_output=True,
+            )
+        except FileNotFoundError:
+            raise pytesseract.TesseractNotFoundError()
+        if proc.returncode != 0:
+            raise pytesseract.TesseractError(proc.returncode, proc.stderr.decode("utf-8", "replace").strip())
+        return proc.stdout.decode("utf-8")
+    
+    try:
+        api = _TESSEROCR_APIS.get_nowait()
+    except queue.Empty:
+        api = _tesserocr.PyTessBaseAPI(lang="eng")
+    try:
+        api.SetImageBytes(pix.samples, pix.width, pix.height, pix.n, pix.stride)
+        return api.GetUTF8Text()
+    finally:
+        _TESSEROCR_APIS.put(api)
+
+
+# Keep tiktoken's BPE file in a persistent cache (its default is the system temp
+# dir, which is wiped on reboot and forces a re-download on the next first call).
+os.environ.setdefault("TIKTOKEN_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "tiktoken"))
+
+_TOKENIZER = None
+
 
+def get_tokenizer() -> tiktoken.Encoding:
+    """Shared cl100k_base encoder, loaded on first use and reused by all chunking/counting calls"""
+    global _TOKENIZER
+    if _TOKENIZER is None:
+        _TOKENIZER = tiktoken.get_encoding("cl100k_base")
+    return _TOKENIZER
 
+
+@lru_cache(maxsize=2048)
 def count_tokens(text: str) -> int:
-    """Count tokens using tiktoken (cl100k_base)"""
-    enc = tiktoken.get_encoding("cl100k_base")
-    return len(enc.encode(text))
+    """Count tokens using tiktoken (cl100k_base); memoized, since chat re-counts the same retrieved chunks"""
+    return len(get_tokenizer().encode_ordinary(text))
 
 
 # =============================================================================
@@ -49,7 +175,50 @@ def extract_toc(doc: fitz.Document) -> Dict[int, str]:
     return {}
 
 
-def extract_toc_from_text(doc: fitz.Document) -> Dict[int, str]:
+# Line patterns for the text-based TOC parsers, compiled once
+_UNIT_HDR_RE = re.compile(r'^(Unit\s+\d+\.?\d*|Chapter\s+\d+|Lesson\s+\d+)\s*$', re.IGNORECASE)  # "Unit 1.2" alone
+_UNIT_INLINE_RE = re.compile(r'^(Unit\s+\d+\.?\d*|Chapter\s+\d+)\s+(.+?)\s*$', re.IGNORECASE)  # "Unit 1 Title"
+_UNIT_LABEL_WORD_RE = re.compile(r'^(Unit|Chapter|Lesson)$', re.IGNORECASE)  # label split from its number
+_UNIT_NUMBER_RE = re.compile(r'^\d+\.?\d*$')  # "3" or "3.1"
+_INLINE_TITLE_PAGE_RE = re.compile(r'^(.+?)\s{2,}(\d{1,3})\s*$')  # "Title    12"
+_PAGE_RANGE_RE = re.compile(r'^(\d{1,3})\s*[–\-]\s*\d{1,3}$')  # "1 – 25"
+# Header/column-label lines in text TOCs (never titles or page numbers)
+_TOC_SKIP_WORDS = frozenset({
+    'contents', 'unit', 'topic', 'page', 's.n.', 'page no', 'sn',
+    'title', 'reading', 'speaking', 'listening', 'grammar', 'writing',
+    'project', 'work', 'project work', 'vocabulary', 'section one',
+    'section two', 'section one: language development', 'section two: literature',
+    'table of contents', 'preface'
+})
+# Common section headers on chapter start pages (not unit titles)
+_SECTION_HEADERS = frozenset({
+    'getting started', 'reading i', 'reading ii', 'reading',
+    'look at the picture', 'before you read', 'answer',
+    'discuss', 'listening', 'speaking', 'writing', 'grammar',
+    'project work', 'vocabulary'
+})
+# Line prefixes that rule a chapter-title candidate out: section headers (an
+# exact header also starts with itself) and obvious content such as questions
+_TITLE_SKIP_STARTS = tuple(_SECTION_HEADERS) + ('a.', 'b.', 'c.', 'look at', 'what do', 'how do', 'answer')
+# Cue words counted on lower-cased page text (substring counts, like str.count)
+_TOC_PAGE_WORD_RE = re.compile(r'contents|unit|chapter|lesson')
+# The text parser stops scanning once it has a few entries and more than this many
+# pages in a row added none. Assumes a TOC split across pages is interrupted by at most
+# this many pages (preface, foreword, a full-page image) before it continues.
+_TOC_MAX_GAP_PAGES = 3
+
+
+def _is_bare_num(line: str, max_digits: int = 3) -> bool:
+    """True for a stripped line that is just a 1..`max_digits` digit number (same as ^\\d{1,n}$)"""
+    return 0 < len(line) <= max_digits and line.isdecimal()
+
+
+def _get_first_n_texts(doc: fitz.Document, n: int = 10) -> List[str]:
+    """Text layer of the first `n` pages, extracted once and shared by the TOC tiers ("" for scans)"""
+    return [text or "" for _, text in _extract_text_range(doc, 0, min(n, len(doc)))]
+
+
+def extract_toc_from_text(doc: fitz.Document, page_texts: Optional[List[str]] = None) -> Dict[int, str]:
     """
     Tier 1.5: Parse TOC directly from page text using multiple regex patterns.
     Handles formats from various Nepali curriculum textbooks:
@@ -58,52 +227,52 @@ def extract_toc_from_text(doc: fitz.Document) -> Dict[int, str]:
       - English: multi-column table (unit_num / title / ... / page_num)
       - Maths: page-range (1 / Sets / 1 – 25)
       - Optional Math: two-line (Unit 1: Algebra / 1)
+    `page_texts` is the `_get_first_n_texts(doc)` list when the caller already has it.
     """
     toc_map = {}
     
     pages_to_scan = min(10, len(doc))
-    skip_words = {
-        'contents', 'unit', 'topic', 'page', 's.n.', 'page no', 'sn',
-        'title', 'reading', 'speaking', 'listening', 'grammar', 'writing',
-        'project', 'work', 'project work', 'vocabulary', 'section one',
-        'section two', 'section one: language development', 'section two: literature',
-        'table of contents', 'preface'
-    }
+    if page_texts is None:
+        page_texts = _get_first_n_texts(doc, pages_to_scan)
     
+    last_entry_page = -1  # last page that added TOC entries
     for page_idx in range(pages_to_scan):
-        text = doc[page_idx].get_text()
+        # The TOC has ended once it has entries and more than _TOC_MAX_GAP_PAGES pages in a row added none
+        if len(toc_map) >= 3 and page_idx - last_entry_page - 1 > _TOC_MAX_GAP_PAGES:
+            break
+        
+        text = page_texts[page_idx]
         if not text.strip():
             continue
         
-        lines = [line.strip() for line in text.split('\n') if line.strip()]
-        
-        text_lower = text.lower()
+        # One scan for all four cue words instead of an `in` plus three count() passes
+        cues = Counter(_TOC_PAGE_WORD_RE.findall(text.lower()))
         is_toc_page = (
-            'contents' in text_lower 
-            or text_lower.count('unit') >= 3
-            or text_lower.count('chapter') >= 3
-            or text_lower.count('lesson') >= 3
+            cues['contents'] > 0
+            or cues['unit'] >= 3
+            or cues['chapter'] >= 3
+            or cues['lesson'] >= 3
         )
         
         if not is_toc_page:
             continue
         
+        lines = [line.strip() for line in text.split('\n') if line.strip()]
+        
         logger.info(f"Found potential TOC on page {page_idx + 1}")
+        entries_before = len(toc_map)
         
         # ------- Pattern 1: Unit/Chapter label + Title + Page (3-line) -------
         i = 0
         while i < len(lines) - 1:
             line = lines[i]
             
-            unit_match = re.match(
-                r'^(Unit\s+\d+\.?\d*|Chapter\s+\d+|Lesson\s+\d+)\s*$',
-                line, re.IGNORECASE
-            )
+            unit_match = _UNIT_HDR_RE.match(line)
             
             if unit_match and i + 2 < len(lines):
-                unit_label = unit_match.group(1).strip()
-                title = lines[i + 1].strip()
-                page_str = lines[i + 2].strip()
+                unit_label = unit_match.group(1)
+                title = lines[i + 1]
+                page_str = lines[i + 2]
                 
                 if title and not title[0].isdigit() and page_str.isdigit():
                     page_num = int(page_str)
@@ -113,14 +282,11 @@ def extract_toc_from_text(doc: fitz.Document) -> Dict[int, str]:
                         continue
             
             # ------- Pattern 2: Unit+Title inline + Page -------
-            unit_inline = re.match(
-                r'^(Unit\s+\d+\.?\d*|Chapter\s+\d+)\s+(.+?)\s*$',
-                line, re.IGNORECASE
-            )
+            unit_inline = _UNIT_INLINE_RE.match(line)
             if unit_inline and i + 1 < len(lines):
-                unit_label = unit_inline.group(1).strip()
-                title = unit_inline.group(2).strip()
-                page_str = lines[i + 1].strip()
+                unit_label = unit_inline.group(1)
+                title = unit_inline.group(2)
+                page_str = lines[i + 1]
                 
                 if title and page_str.isdigit():
                     page_num = int(page_str)
@@ -130,9 +296,9 @@ def extract_toc_from_text(doc: fitz.Document) -> Dict[int, str]:
                         continue
             
             # ------- Pattern 3: Inline "Title ... PageNum" -------
-            inline_match = re.match(r'^(.+?)\s{2,}(\d{1,3})\s*$', line)
+            inline_match = _INLINE_TITLE_PAGE_RE.match(line)
             if inline_match:
-                title = inline_match.group(1).strip()
+                title = inline_match.group(1)
                 page_num = int(inline_match.group(2))
                 if title and 1 <= page_num <= 999 and len(title) > 3:
                     toc_map[page_num] = title
@@ -140,20 +306,20 @@ def extract_toc_from_text(doc: fitz.Document) -> Dict[int, str]:
                     continue
             
             # Skip header/column-label words
-            if line.lower() in skip_words:
+            if line.lower() in _TOC_SKIP_WORDS:
                 i += 1
                 continue
             
             # ------- Pattern 4: Numbered list (Science) -------
             # bare number + title + page_number
-            if re.match(r'^\d{1,2}$', line) and i + 2 < len(lines):
+            if _is_bare_num(line, 2) and i + 2 < len(lines):
                 unit_num = line
-                title_line = lines[i + 1].strip()
-                page_str = lines[i + 2].strip()
+                title_line = lines[i + 1]
+                page_str = lines[i + 2]
                 
                 if (title_line 
-                    and not re.match(r'^\d+$', title_line) 
-                    and title_line.lower() not in skip_words
+                    and not title_line.isdecimal() 
+                    and title_line.lower() not in _TOC_SKIP_WORDS
                     and page_str.isdigit()):
                     page_num = int(page_str)
                     if 1 <= page_num <= 999:
@@ -163,10 +329,10 @@ def extract_toc_from_text(doc: fitz.Document) -> Dict[int, str]:
                 
                 # ------- Pattern 5: Page-range format (Maths) -------
                 # bare_number + title + "start – end" or "start-end"
-                range_match = re.match(r'^(\d{1,3})\s*[–\-]\s*\d{1,3}$', page_str)
+                range_match = _PAGE_RANGE_RE.match(page_str)
                 if (title_line 
-                    and not re.match(r'^\d+$', title_line)
-                    and title_line.lower() not in skip_words
+                    and not title_line.isdecimal()
+                    and title_line.lower() not in _TOC_SKIP_WORDS
                     and range_match):
                     page_num = int(range_match.group(1))
                     if 1 <= page_num <= 999:
@@ -175,6 +341,9 @@ def extract_toc_from_text(doc: fitz.Document) -> Dict[int, str]:
                         continue
             
             i += 1
+        
+        if len(toc_map) > entries_before:
+            last_entry_page = page_idx
     
     # ------- Pattern 6: Multi-column table TOC (English textbooks) -------
     # These have: unit_num, title (possibly multi-word/multi-line), then lots of 
@@ -182,7 +351,7 @@ def extract_toc_from_text(doc: fitz.Document) -> Dict[int, str]:
     # Strategy: collect all lines from TOC pages, find sequences of 
     # (unit_number, title_text, ..., page_number)
     if not toc_map:
-        toc_map = _parse_multicolumn_toc(doc, pages_to_scan, skip_words)
+        toc_map = _parse_multicolumn_toc(doc, pages_to_scan, page_texts)
     
     if toc_map:
         logger.info(f"Text-based parser extracted {len(toc_map)} TOC entries")
@@ -191,7 +360,7 @@ def extract_toc_from_text(doc: fitz.Document) -> Dict[int, str]:
 
 
 def _parse_multicolumn_toc(
-    doc: fitz.Document, pages_to_scan: int, skip_words: set
+    doc: fitz.Document, pages_to_scan: int, page_texts: Optional[List[str]] = None
 ) -> Dict[int, str]:
     """
     Parse multi-column table TOCs (common in English textbooks).
@@ -199,24 +368,40 @@ def _parse_multicolumn_toc(
         unit_num (1) → title lines → page_num (1) → unit_num (2) → title → page_num (13) → ...
     Strategy: first collect all bare numbers, then pair them as (unit, page) based on sequence.
     """
-    # Collect all lines from TOC pages (including continuation pages)
+    # Collect all lines from TOC pages (including continuation pages), and
+    # the bare number positions among them, in the same pass
     all_lines = []
+    num_positions = []  # [(index in all_lines, value)]
     prev_was_toc = False
+    if page_texts is None:
+        page_texts = _get_first_n_texts(doc, pages_to_scan)
     for page_idx in range(pages_to_scan):
-        text = doc[page_idx].get_text()
+        text = page_texts[page_idx]
         text_lower = text.lower()
-        lines = [l.strip() for l in text.split('\n') if l.strip()]
         
         is_toc_page = 'contents' in text_lower or text_lower.count('unit') >= 2
+        if not is_toc_page and not prev_was_toc:
+            continue
+        
+        lines = []
+        bare = []  # indices into `lines` of bare numbers
+        for raw in text.split('\n'):
+            line = raw.strip()
+            if line:
+                if _is_bare_num(line):
+                    bare.append(len(lines))
+                lines.append(line)
         
         # Also include continuation pages: right after a TOC page,
         # with lots of bare numbers (table structure)
-        if not is_toc_page and prev_was_toc:
-            bare_nums = sum(1 for l in lines if re.match(r'^\d{1,3}$', l))
-            if bare_nums >= 3:
-                is_toc_page = True
+        if not is_toc_page and len(bare) >= 3:
+            is_toc_page = True
         
         if is_toc_page:
+            offset = len(all_lines)
+            num_positions.extend(
+                (offset + k, int(lines[k])) for k in bare if lines[k].lower() not in _TOC_SKIP_WORDS
+            )
             all_lines.extend(lines)
             prev_was_toc = True
         else:
@@ -225,12 +410,6 @@ def _parse_multicolumn_toc(
     if not all_lines:
         return {}
     
-    # Find all bare number positions and the text between them
-    num_positions = []  # [(index, value)]
-    for i, line in enumerate(all_lines):
-        if re.match(r'^\d{1,3}$', line) and line.lower() not in skip_words:
-            num_positions.append((i, int(line)))
-    
     if len(num_positions) < 2:
         return {}
     
@@ -241,55 +420,44 @@ def _parse_multicolumn_toc(
     
     entries = []  # (unit_num, title, page_num)
     
-    # Find the starting unit (usually 1)
-    ni = 0
-    while ni < len(num_positions) and num_positions[ni][1] != 1:
-        ni += 1
-    
-    if ni >= len(num_positions):
-        return {}
+    def add_entry(unit_num, title, page_num):
+        if title and page_num is not None:
+            entries.append((unit_num, f"Unit {unit_num}: {title}", page_num))
     
-    expected_unit = 1
-    while ni < len(num_positions):
-        idx, val = num_positions[ni]
-        
-        if val != expected_unit:
-            ni += 1
-            continue
-        
-        # Found unit number - collect title lines until next bare number
-        # Limit to first ~5 words (title column in multi-column tables is short)
-        title_parts = []
-        title_word_count = 0
-        for j in range(idx + 1, len(all_lines)):
-            line = all_lines[j].strip()
-            if re.match(r'^\d{1,3}$', line):
-                break
-            if line.lower() not in skip_words and len(line) >= 2:
-                title_parts.append(line)
-                title_word_count += len(line.split())
-         # Limit to first ~3 words (title column is short: "Travel and holidays")
-                if title_word_count >= 3:
+    # One left-to-right sweep: an occurrence of the next expected unit number
+    # closes the open unit, whose page is the last number (>= 1) seen since it
+    open_unit = None  # (unit_num, title) still waiting for its page number
+    page_num = None
+    expected_unit = 1  # the starting unit is usually 1
+    for idx, val in num_positions:
+        if val == expected_unit:
+            if open_unit is not None:
+                add_entry(*open_unit, page_num)
+            
+            # Found unit number - collect title lines until next bare number
+            # Limit to first ~5 words (title column in multi-column tables is short)
+            title_parts = []
+            title_word_count = 0
+            for j in range(idx + 1, len(all_lines)):
+                line = all_lines[j]
+                if _is_bare_num(line):
                     break
-        
-        title = ' '.join(title_parts) if title_parts else None
-        
-        # Find the page number: next bare number after title that is NOT the next unit
-        page_num = None
-        for nj in range(ni + 1, len(num_positions)):
-            candidate_num = num_positions[nj][1]
-            if candidate_num == expected_unit + 1:
-                # This is the next unit, so the page_num was the one before this
-                break
-            # Could be page number (must be >= 1)
-            if candidate_num >= 1:
-                page_num = candidate_num
-        
-        if title and page_num is not None:
-            entries.append((expected_unit, f"Unit {expected_unit}: {title}", page_num))
-        
-        expected_unit += 1
-        ni += 1
+                if line.lower() not in _TOC_SKIP_WORDS and len(line) >= 2:
+                    title_parts.append(line)
+                    title_word_count += len(line.split())
+             # Limit to first ~3 words (title column is short: "Travel and holidays")
+                    if title_word_count >= 3:
+                        break
+            
+            open_unit = (expected_unit, ' '.join(title_parts) if title_parts else None)
+            page_num = None
+            expected_unit += 1
+        elif open_unit is not None and val >= 1:
+            # Could be page number (the last one before the next unit wins)
+            page_num = val
+    
+    if open_unit is not None:
+        add_entry(*open_unit, page_num)
     
     # Build toc_map
     toc_map = {}
@@ -316,15 +484,10 @@ def extract_toc_from_chapter_pages(
     if not meta_toc:
         return {}
     
-    # Common section headers to skip (not unit titles)
-    section_headers = {
-        'getting started', 'reading i', 'reading ii', 'reading',
-        'look at the picture', 'before you read', 'answer',
-        'discuss', 'listening', 'speaking', 'writing', 'grammar',
-        'project work', 'vocabulary'
-    }
-    
     toc_map = {}
+    # Pages are visited in ascending order and adjacent entries share a page
+    # (entry N checks N and N+1), so each page's lines are extracted at most once
+    page_lines = {}
     for page_num in sorted(meta_toc.keys()):
         if page_num < 1 or page_num > len(doc):
             continue
@@ -336,20 +499,19 @@ def extract_toc_from_chapter_pages(
         
         found = False
         for pg_idx in pages_to_check:
-            page_text = doc[pg_idx].get_text()
-            lines = [l.strip() for l in page_text.split('\n') if l.strip()]
+            lines = page_lines.get(pg_idx)
+            if lines is None:
+                page_text = doc[pg_idx].get_text("text")
+                lines = page_lines[pg_idx] = [l.strip() for l in page_text.split('\n') if l.strip()]
             
             for idx, line in enumerate(lines):
                 # Match "Unit N", "Unit  N", "Chapter N", "Lesson N"
-                match = re.match(
-                    r'^(Unit\s+\d+\.?\d*|Chapter\s+\d+|Lesson\s+\d+)\s*$',
-                    line, re.IGNORECASE
-                )
+                match = _UNIT_HDR_RE.match(line)
                 if not match:
                     # Also match split format: "Unit" on one line, number on next
-                    if re.match(r'^(Unit|Chapter|Lesson)$', line, re.IGNORECASE) and idx + 1 < len(lines):
-                        next_l = lines[idx + 1].strip()
-                        if re.match(r'^\d+\.?\d*$', next_l):
+                    if _UNIT_LABEL_WORD_RE.match(line) and idx + 1 < len(lines):
+                        next_l = lines[idx + 1]
+                        if _UNIT_NUMBER_RE.match(next_l):
                             match = True
                             label = f"{line} {next_l}"
                             search_start = idx + 2
@@ -361,23 +523,18 @@ def extract_toc_from_chapter_pages(
                 if match is True:
                     pass  # label and search_start already set
                 else:
-                    label = match.group(1).strip()
+                    label = match.group(1)
                     search_start = idx + 1
                 
                 # Now search for the actual title (skip section headers)
                 for j in range(search_start, min(search_start + 10, len(lines))):
-                    candidate = lines[j].strip()
+                    candidate = lines[j]
                     # Skip: numbers, short lines, section headers
                     if not candidate or len(candidate) < 3:
                         continue
-                    if re.match(r'^\d+$', candidate):
-                        continue
-                    if candidate.lower() in section_headers:
+                    if candidate.isdecimal():
                         continue
-                    if any(candidate.lower().startswith(sh) for sh in section_headers):
-                        continue
-                    # Skip lines that are clearly content (questions, etc.)
-                    if candidate.lower().startswith(('a.', 'b.', 'c.', 'look at', 'what do', 'how do', 'answer')):
+                    if candidate.lower().startswith(_TITLE_SKIP_STARTS):
                         continue
                     # This is likely the unit title
                     toc_map[page_num] = f"{label}: {candidate}"
@@ -422,156 +579,287 @@ def get_chapter_for_page(page_num: int, toc_map: Dict[int, str]) -> str:
     return current_chapter
 
 
-def extract_toc_with_docling(pdf_bytes: bytes) -> Dict[int, str]:
+def build_chapter_index(toc_map: Dict[int, str]) -> Tuple[List[int], List[str]]:
+    """Sorted start pages and their titles from `toc_map`, for repeated `chapter_at_page` lookups.
+
+    Keys that aren't page numbers (or are negative) are skipped; if two keys name the same page,
+    the first one wins (same as `get_chapter_for_page`).
     """
-    Tier 2: Use Docling to extract TOC from first 10 pages.
+    starts = {}
+    for start_page, title in toc_map.items():
+        try:
+            sp = int(start_page)
+        except Exception:
+            continue
+        if sp >= 0:
+            starts.setdefault(sp, title)
+    start_pages = sorted(starts)
+    return start_pages, [starts[sp] for sp in start_pages]
+
+
+def chapter_at_page(page_num: int, chapter_index: Tuple[List[int], List[str]]) -> str:
+    """O(log N) equivalent of `get_chapter_for_page` using a prebuilt `build_chapter_index` result"""
+    start_pages, titles = chapter_index
+    idx = bisect.bisect_right(start_pages, page_num) - 1
+    return titles[idx] if idx >= 0 else "Unknown"
+
+
+_TOC_CUE_RE = re.compile(
+    r'\b(?:contents|chapters?|units?|lessons?)\b'
+    # Nepali/Hindi: विषयसूची/अनुक्रमणिका (contents), अध्याय (chapter), एकाइ (unit), पाठ (lesson)
+    r'|विषय\s*-?\s*सूची|अनुक्रमणिका|अध्याय|एकाइ|एकाई|पाठ',
+    re.IGNORECASE,
+)
+
+
+def front_matter_may_have_toc(
+    doc: fitz.Document, max_pages: int = 10, page_texts: Optional[List[str]] = None
+) -> bool:
+    """
+    Cheap pre-check for the model-based TOC tiers.
+    
+    False only when every one of the first `max_pages` pages has a text layer
+    and none of them mentions contents/chapter/unit/lesson (in English or
+    Devanagari, see `_TOC_CUE_RE`). Scanned front
+    matter can't be judged from text, so it always returns True.
+    """
+    if page_texts is None:
+        page_texts = _get_first_n_texts(doc, max_pages)
+    for text in page_texts[:max_pages]:
+        if not text.strip() or _TOC_CUE_RE.search(text):
+            return True
+    return False
+
+
+@lru_cache(maxsize=2)
+def get_docling_converter(do_ocr: bool):
+    """Shared Docling converter (pypdfium2 backend, fast tables), so layout/table models load once per process"""
+    from docling.backend.pypdfium2_backend import PyPdfiumDocumentBackend
+    from docling.datamodel.base_models import InputFormat
+    from docling.datamodel.pipeline_options import PdfPipelineOptions, TableFormerMode
+    from docling.document_converter import DocumentConverter, PdfFormatOption
+    
+    pipeline_options = PdfPipelineOptions()
+    pipeline_options.do_ocr = do_ocr
+    pipeline_options.table_structure_options.mode = TableFormerMode.FAST
+    return DocumentConverter(format_options={
+        InputFormat.PDF: PdfFormatOption(pipeline_options=pipeline_options, backend=PyPdfiumDocumentBackend)
+    })
+
+
+def extract_toc_with_docling(
+    doc: fitz.Document, page_texts: Optional[List[str]] = None, failures: Optional[List[str]] = None
+) -> Dict[int, str]:
+    """
+    Tier 2: Use Docling to extract TOC from first 10 pages of the open `doc`.
     Improved: Handles multiple table formats, header patterns, and nested structures.
+    If the tier errors at runtime, a reason is appended to `failures` (when given);
+    Docling not being installed is not a failure.
     Returns: Dict mapping page numbers to chapter/unit titles
     """
     try:
-        from docling.document_converter import DocumentConverter
+        from docling.datamodel.base_models import DocumentStream
         
         logger.info("Extracting TOC with Docling (first 10 pages only)...")
         
-        import tempfile
+        # Copy the first 10 pages into an in-memory PDF (no temp file round trip)
+        pages_to_extract = min(10, len(doc))
+        small_doc = fitz.open()
+        try:
+            small_doc.insert_pdf(doc, from_page=0, to_page=pages_to_extract - 1)
+            small_pdf = small_doc.tobytes()
+        finally:
+            small_doc.close()
         
-        # Open the full PDF and extract first 10 pages
-        full_doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-        pages_to_extract = min(10, len(full_doc))
+        # Docling's OCR only runs when some front-matter page has no text layer
+        if page_texts is None:
+            page_texts = _get_first_n_texts(doc, pages_to_extract)
+        do_ocr = not all(text.strip() for text in page_texts[:pages_to_extract])
         
-        # Create a new PDF with only first 10 pages
-        small_doc = fitz.open()
-        for i in range(pages_to_extract):
-            small_doc.insert_pdf(full_doc, from_page=i, to_page=i)
+        # Process only the small 10-page PDF
+        result = get_docling_converter(do_ocr).convert(DocumentStream(name="toc.pdf", stream=io.BytesIO(small_pdf)))
         
-        # Save to temp file
-        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp:
-            small_doc.save(tmp.name)
-            tmp_path = tmp.name
+        # Parse TOC from markdown output
+        toc_map = {}
+        md_content = result.document.export_to_markdown()
         
-        small_doc.close()
-        full_doc.close()
+        lines = md_content.split('\n')
+        in_toc_table = False
         
-        try:
-            # Process only the small 10-page PDF
-            converter = DocumentConverter()
-            result = converter.convert(tmp_path)
-            
-            # Parse TOC from markdown output
-            toc_map = {}
-            md_content = result.document.export_to_markdown()
-            
-            lines = md_content.split('\n')
-            in_toc_table = False
+        for line in lines:
+            # Detect TOC table header (flexible matching)
+            lower_line = line.lower()
+            if any(keyword in lower_line for keyword in [
+                '| unit', '| topic', '| page', '| chapter', '| lesson',
+                '| content', '| title', '| s.n', '| sn'
+            ]):
+                in_toc_table = True
+                continue
             
-            for line in lines:
-                # Detect TOC table header (flexible matching)
-                lower_line = line.lower()
-                if any(keyword in lower_line for keyword in [
-                    '| unit', '| topic', '| page', '| chapter', '| lesson',
-                    '| content', '| title', '| s.n', '| sn'
-                ]):
-                    in_toc_table = True
-                    continue
-                
-                # Skip separator line
-                if in_toc_table and (line.startswith('|--') or line.startswith('| --')):
-                    continue
-                    
-                # Parse TOC rows
-                if in_toc_table and line.startswith('|'):
-                    parts = [p.strip() for p in line.split('|') if p.strip()]
-                    if len(parts) >= 2:
-                        try:
-                            # Try to find page number (usually last column or a numeric column)
-                            page_num = None
-                            title_parts = []
-                            
-                            for part in parts:
-                                # Check if this part is a page number
-                                clean = re.sub(r'[^\d]', '', part)
-                                if clean and clean.isdigit() and 1 <= int(clean) <= 999:
-                                    if page_num is None:  # Take first valid page number
-                                        page_num = int(clean)
-                                else:
-                                    # Skip pure numbers that are S.N. columns
-                                    if not (part.isdigit() and int(part) < 30):
-                                        title_parts.append(part)
-                            
-                            if page_num and title_parts:
-                                title = ' - '.join(title_parts).strip()
-                                # Clean up title
-                                title = re.sub(r'\s+', ' ', title)
-                                if title and len(title) > 2:
-                                    toc_map[page_num] = title
-                        except (ValueError, IndexError):
-                            pass
+            # Skip separator line
+            if in_toc_table and (line.startswith('|--') or line.startswith('| --')):
+                continue
                 
-                # End of table
-                if in_toc_table and not line.startswith('|') and line.strip():
-                    in_toc_table = False
-            
-            # Also look for ## headers as section markers (improved)
-            for line in lines[:200]:
-                if line.startswith('## ') and not line.startswith('## ©'):
-                    section_title = line[3:].strip()
-                    if section_title and section_title not in ['Contents', 'Preface', 'Table of Contents']:
-                        # Don't overwrite TOC entries from table parsing
+            # Parse TOC rows
+            if in_toc_table and line.startswith('|'):
+                parts = [p.strip() for p in line.split('|') if p.strip()]
+                if len(parts) >= 2:
+                    try:
+                        # Try to find page number (usually last column or a numeric column)
+                        page_num = None
+                        title_parts = []
+                        
+                        for part in parts:
+                            # Check if this part is a page number
+                            clean = re.sub(r'[^\d]', '', part)
+                            if clean and clean.isdigit() and 1 <= int(clean) <= 999:
+                                if page_num is None:  # Take first valid page number
+                                    page_num = int(clean)
+                            else:
+                                # Skip pure numbers that are S.N. columns
+                                if not (part.isdigit() and int(part) < 30):
+                                    title_parts.append(part)
+                        
+                        if page_num and title_parts:
+                            title = ' - '.join(title_parts).strip()
+                            # Clean up title
+                            title = re.sub(r'\s+', ' ', title)
+                            if title and len(title) > 2:
+                                toc_map[page_num] = title
+                    except (ValueError, IndexError):
                         pass
             
-            logger.info(f"Docling extracted {len(toc_map)} TOC entries")
-            return toc_map
-            
-        finally:
-            os.unlink(tmp_path)  # Clean up temp file
+            # End of table
+            if in_toc_table and not line.startswith('|') and line.strip():
+                in_toc_table = False
+        
+        # Also look for ## headers as section markers (improved)
+        for line in lines[:200]:
+            if line.startswith('## ') and not line.startswith('## ©'):
+                section_title = line[3:].strip()
+                if section_title and section_title not in ['Contents', 'Preface', 'Table of Contents']:
+                    # Don't overwrite TOC entries from table parsing
+                    pass
+        
+        logger.info(f"Docling extracted {len(toc_map)} TOC entries")
+        return toc_map
             
     except ImportError:
-        logger.warning("Docling not installed. Falling back to Groq TOC extraction.")
+        _warn_once("Docling not installed. Falling back to Groq TOC extraction.")
         return {}
     except Exception as e:
         logger.error(f"Docling TOC extraction failed: {e}")
+        if failures is not None:
+            failures.append(f"docling: {e}")
         return {}
 
 
-def extract_toc_with_groq(pdf_bytes: bytes) -> Dict[int, str]:
+_GROQ_CLIENT = None
+
+
+def get_groq_client(api_key: str):
+    """Shared Groq client, so TOC extraction and chat reuse one HTTP connection pool; rebuilt if the key changes"""
+    global _GROQ_CLIENT
+    if _GROQ_CLIENT is None or _GROQ_CLIENT.api_key != api_key:
+        from groq import Groq
+        _GROQ_CLIENT = Groq(api_key=api_key)
+    return _GROQ_CLIENT
+
+
+_GROQ_TOC_SYSTEM_PROMPT = """You are a TOC extraction expert. Extract the Table of Contents from the given textbook pages.
+Return ONLY valid JSON in this exact format (no markdown, no explanation):
+{"toc": [{"page": <page_number>, "title": "<chapter/unit title>"}]}
+
+Rules:
+- Include ALL chapters, units, lessons, and major sections
+- Use the ACTUAL page numbers shown in the TOC, not the PDF page numbers
+- If no TOC is found, return {"toc": []}
+- Clean up titles (remove extra whitespace, numbering artifacts)"""
+
+# One {"page": N, "title": "..."} object from an LLM TOC response
+_TOC_ENTRY_RE = re.compile(r'"page"\s*:\s*"?(\d{1,4})"?\s*,\s*"title"\s*:\s*"((?:[^"\\\n]|\\.){2,200})"')
+_TOC_SCRAPE_MAX_CHARS = 20000
+
+
+def _scrape_toc_entries(text: str) -> List[Dict]:
+    """Regex fallback for malformed TOC JSON: the well-formed page/title pairs it contains"""
+    entries = []
+    for page, raw_title in _TOC_ENTRY_RE.findall(text[:_TOC_SCRAPE_MAX_CHARS]):
+        try:
+            title = json.loads(f'"{raw_title}"')  # undo JSON string escapes
+        except json.JSONDecodeError:
+            title = raw_title
+        entries.append({"page": page, "title": title})
+    return entries
+
+
+def _groq_toc_prompt_pages(texts: List[Optional[str]]) -> str:
+    """
+    Front-page texts joined into the Groq TOC prompt body, each under a "--- PAGE n ---" marker.
+    
+    Past the title pages, only pages with TOC cues (English or Devanagari, see
+    `_TOC_CUE_RE`) are sent, so the 8000-char budget isn't spent on prefaces
+    and the first chapter's prose.
+    """
+    parts = []
+    for i, text in enumerate(texts):
+        if not text or not text.strip() or (i > 2 and not _TOC_CUE_RE.search(text)):
+            continue
+        parts.append(f"\n--- PAGE {i+1} ---\n")
+        parts.append(text)
+    return "".join(parts)
+
+
+def extract_toc_with_groq(
+    doc: fitz.Document, page_texts: Optional[List[str]] = None, failures: Optional[List[str]] = None
+) -> Dict[int, str]:
     """
-    Tier 3: Use Groq LLM to extract TOC from first 5 pages via OCR text.
+    Tier 3: Use Groq LLM to extract TOC from the first pages of the open `doc` (OCR for scanned ones).
     Handles non-standard textbook layouts that Docling can't parse.
+    `page_texts` is the `_get_first_n_texts(doc)` list when the caller already has it.
+    If the tier errors at runtime (or a page fails OCR), a reason is appended to `failures`
+    (when given); an unset GROQ_API_KEY or missing groq package is not a failure.
     Returns: Dict mapping page numbers to chapter/unit titles
     """
+    if failures is None:
+        failures = []
     groq_api_key = os.getenv("GROQ_API_KEY")
     if not groq_api_key:
-        logger.warning("GROQ_API_KEY not set. Cannot use Groq TOC extraction.")
+        _warn_once("GROQ_API_KEY not set. Cannot use Groq TOC extraction.")
         return {}
     
     try:
         logger.info("Extracting TOC with Groq LLM (first 5 pages)...")
         
-        # Extract text from first 5 pages
-        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+        # Text layer of the first pages, shared with the earlier tiers
         pages_to_check = min(10, len(doc))
+        if page_texts is None:
+            page_texts = _get_first_n_texts(doc, pages_to_check)
+        texts = list(page_texts[:pages_to_check])
         
-        first_pages_text = ""
-        for i in range(pages_to_check):
-            page = doc[i]
-            text = page.get_text()
-            if text.strip():
-                first_pages_text += f"\n--- PAGE {i+1} ---\n{text}"
-            else:
-                # OCR fallback for scanned pages
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            ocr_futures = {}
+            for i, text in enumerate(texts):
+                if text.strip():
+                    continue
+                # OCR fallback for scanned pages: render here (fitz is not
+                # thread-safe) and let the Tesseract runs overlap
                 try:
-                    pix = page.get_pixmap(dpi=200)
-                    img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-                    text = pytesseract.image_to_string(img)
-                    if text.strip():
-                        first_pages_text += f"\n--- PAGE {i+1} ---\n{text}"
-                except Exception:
-                    pass
+                    pix = doc[i].get_pixmap(dpi=OCR_DPI, colorspace=fitz.csGRAY)
+                except Exception as e:
+                    failures.append(f"groq: render of page {i + 1} failed: {e}")
+                    continue
+                ocr_futures[i] = executor.submit(tesseract_pixmap_to_string, pix)
+            for i, future in ocr_futures.items():
+                try:
+                    texts[i] = future.result()
+                except Exception as e:
+                    failures.append(f"groq: OCR of page {i + 1} failed: {e}")
         
-        doc.close()
+        first_pages_text = _groq_toc_prompt_pages(texts)
         
         if not first_pages_text.strip():
-            logger.warning("No text found in first 5 pages for Groq TOC extraction")
+            logger.warning("No text found in first pages for Groq TOC extraction")
             return {}
         
         # Truncate to avoid token limits
@@ -579,24 +867,10 @@ def extract_toc_with_groq(pdf_bytes: bytes) -> Dict[int, str]:
             first_pages_text = first_pages_text[:8000]
         
         # Call Groq LLM
-        from groq import Groq
-        client = Groq(api_key=groq_api_key)
-        
-        response = client.chat.completions.create(
+        response = get_groq_client(groq_api_key).chat.completions.create(
             model="llama-3.3-70b-versatile",
             messages=[
-                {
-                    "role": "system",
-                    "content": """You are a TOC extraction expert. Extract the Table of Contents from the given textbook pages.
-Return ONLY valid JSON in this exact format (no markdown, no explanation):
-{"toc": [{"page": <page_number>, "title": "<chapter/unit title>"}]}
-
-Rules:
-- Include ALL chapters, units, lessons, and major sections
-- Use the ACTUAL page numbers shown in the TOC, not the PDF page numbers
-- If no TOC is found, return {"toc": []}
-- Clean up titles (remove extra whitespace, numbering artifacts)"""
-                },
+                {"role": "system", "content": _GROQ_TOC_SYSTEM_PROMPT},
                 {
                     "role": "user",
                     "content": f"Extract the Table of Contents from these textbook pages:\n\n{first_pages_text}"
@@ -609,13 +883,20 @@ Rules:
         result_text = response.choices[0].message.content.strip()
         
         # Parse JSON response
-        # Handle potential markdown code blocks in response
-        if result_text.startswith("```"):
-            result_text = re.sub(r'^```\w*\n?', '', result_text)
-            result_text = re.sub(r'\n?```$', '', result_text)
+        # Keep only the outermost {...}: drops markdown fences and any preamble
+        # or trailing remarks the model wraps around the object
+        first, last = result_text.find("{"), result_text.rfind("}")
+        if first != -1 and last > first:
+            result_text = result_text[first:last + 1]
         
-        toc_data = json.loads(result_text)
-        toc_entries = toc_data.get("toc", [])
+        try:
+            toc_data = json.loads(result_text)
+            toc_entries = toc_data.get("toc", [])
+        except json.JSONDecodeError:
+            # Truncated (max_tokens) or chatty output: salvage the complete
+            # entries instead of discarding the whole LLM call
+            toc_entries = _scrape_toc_entries(result_text)
+            logger.info(f"Groq TOC response was not valid JSON; salvaged {len(toc_entries)} entries")
         
         toc_map = {}
         for entry in toc_entries:
@@ -630,8 +911,12 @@ Rules:
         logger.info(f"Groq LLM extracted {len(toc_map)} TOC entries")
         return toc_map
         
+    except ImportError:
+        _warn_once("groq not installed. Cannot use Groq TOC extraction.")
+        return {}
     except Exception as e:
         logger.error(f"Groq TOC extraction failed: {e}")
+        failures.append(f"groq: {e}")
         return {}
 
 
@@ -639,21 +924,158 @@ Rules:
 # PDF PROCESSING — Hybrid: Docling (TOC) + Tesseract (OCR)
 # =============================================================================
 
+def _extract_text_range(doc: fitz.Document, start: int, stop: int) -> List[Tuple[int, Optional[str]]]:
+    """
+    Text layer of pages [start, stop) as (page_index, text) pairs.
+    
+    A page that references no fonts cannot have a text layer (typical scanned
+    page), so its text is None and extraction is skipped entirely.
+    """
+    results = []
+    for i in range(start, stop):
+        page = doc[i]
+        results.append((i, page.get_text("text") if page.get_fonts() else None))
+    return results
+
+
+# Worker processes (text extraction / OCR) open the PDF once in their
+# initializer and keep it here; tasks then carry only page numbers. The bytes
+# reach each worker once at start-up instead of being pickled into every task.
+_WORKER_DOC = None
+
+
+def _pdf_worker_context():
+    """
+    Start method for the PDF worker pools.
+    
+    Forking the API process would hand children its threads' held locks and the
+    psycopg2 pool's sockets, so workers start from a clean forkserver process
+    (with this module preloaded, so each worker skips the fitz/numpy imports)
+    or, where forkserver is unavailable, are spawned.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context("forkserver")
+        ctx.set_forkserver_preload([__name__])
+        return ctx
+    return multiprocessing.get_context("spawn")
+
+
+def _init_pdf_worker(pdf_bytes: bytes):
+    """Worker process setup: open the PDF once and keep Tesseract single-threaded"""
+    global _WORKER_DOC
+    # Parallelism comes from the worker processes; OpenMP threads inside each
+    # Tesseract call would only oversubscribe the cores.
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+    _WORKER_DOC = fitz.open(stream=pdf_bytes, filetype="pdf")
+
+
+def _extract_worker_text_range(start: int, stop: int) -> List[Tuple[int, Optional[str]]]:
+    return _extract_text_range(_WORKER_DOC, start, stop)
+
+
+def _render_ocr_pixmap(page_index: int) -> fitz.Pixmap:
+    # Tesseract binarizes internally, so grayscale loses nothing and is 1/3 the bytes
+    return _WORKER_DOC[page_index].get_pixmap(dpi=OCR_DPI, colorspace=fitz.csGRAY)
+
+
+def _ocr_page_batch(page_indices: List[int]) -> List[Tuple[int, Optional[str]]]:
+    """Render and OCR pages of the worker's document, returning (page_index, text) pairs (None text = failed)"""
+    results = []
+    # Pipeline the two stages: a single render thread (the only thread touching
+    # the document) prepares the next page while Tesseract, which releases the
+    # GIL, recognizes the current one. At most two pixmaps are alive at a time.
+    with ThreadPoolExecutor(max_workers=1) as renderer:
+        pending = renderer.submit(_render_ocr_pixmap, page_indices[0]) if page_indices else None
+        for n, i in enumerate(page_indices):
+            current = pending
+            if n + 1 < len(page_indices):
+                pending = renderer.submit(_render_ocr_pixmap, page_indices[n + 1])
+            try:
+                results.append((i, tesseract_pixmap_to_string(current.result())))
+            except Exception as e:
+                logger.error(f"OCR failed for Page {i + 1}: {e}")
+                results.append((i, None))
+    # MuPDF caches decoded images/fonts per rendered page and never evicts
+    # on its own; empty the store so long OCR runs keep a flat footprint.
+    fitz.TOOLS.store_shrink(100)
+    return results
+
+
 def process_pdf(pdf_bytes: bytes) -> List[Dict]:
     """
-    HYBRID PDF Processor with improved chunking and TOC support.
+    Chunk a PDF, reusing the stored result when the same file (by SHA-256) was processed before.
     
-    Pipeline:
-    1. TOC extraction: PyMuPDF metadata → Docling → Groq LLM (3-tier fallback)
-    2. Text extraction: PyMuPDF text layer → Tesseract OCR (parallel)
-    3. Cross-page chunking: Concatenate all text, then chunk with sliding window
-    4. TOC summary chunk: Dedicated searchable chunk with all chapters/units
-    5. Chapter tagging: Each chunk tagged with its chapter from TOC
+    Re-uploads of a textbook skip TOC extraction, OCR and chunking entirely.
+    Entries expire after PDF_CHUNK_CACHE_TTL seconds, and results from a run where a
+    TOC tier or an OCR page errored are not stored, so they are redone on the next upload.
+    Set PDF_CHUNK_CACHE_DIR to an empty string to disable the cache.
     """
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-    logger.info(f"Processing PDF with {len(doc)} pages")
+    cache_path = None
+    if PDF_CHUNK_CACHE_DIR:
+        digest = hashlib.sha256(pdf_bytes).hexdigest()
+        cache_path = os.path.join(PDF_CHUNK_CACHE_DIR, f"v{PDF_CHUNK_CACHE_VERSION}-{digest}.json")
+        try:
+            if time.time() - os.path.getmtime(cache_path) < PDF_CHUNK_CACHE_TTL:
+                with open(cache_path, "r", encoding="utf-8") as f:
+                    chunks = json.load(f)
+                logger.info(f"Chunk cache hit for {digest[:12]}: {len(chunks)} chunks")
+                return chunks
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable chunk cache entry {cache_path}: {e}")
     
-    # ─── STEP 1: Extract TOC (multi-tier with quality check) ───
+    chunks, failures = _process_pdf_uncached(pdf_bytes)
+    
+    if cache_path and failures:
+        logger.warning(f"Not caching chunks for {digest[:12]}: {len(failures)} extraction failure(s), e.g. {failures[0]}")
+    elif cache_path and chunks:
+        _prune_chunk_cache()
+        try:
+            os.makedirs(PDF_CHUNK_CACHE_DIR, exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(chunks, f)
+            os.replace(tmp_path, cache_path)  # atomic: readers never see a partial file
+        except OSError as e:
+            logger.warning(f"Could not write chunk cache entry {cache_path}: {e}")
+    return chunks
+
+
+def _prune_chunk_cache():
+    """Delete chunk cache files older than PDF_CHUNK_CACHE_TTL or written by another cache version"""
+    current_prefix = f"v{PDF_CHUNK_CACHE_VERSION}-"
+    cutoff = time.time() - PDF_CHUNK_CACHE_TTL
+    try:
+        entries = list(os.scandir(PDF_CHUNK_CACHE_DIR))
+    except FileNotFoundError:
+        return
+    except OSError as e:
+        logger.warning(f"Could not list chunk cache {PDF_CHUNK_CACHE_DIR}: {e}")
+        return
+    for entry in entries:
+        try:
+            if not entry.is_file():
+                continue
+            if not entry.name.startswith(current_prefix) or entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass  # removed concurrently by another worker
+        except OSError as e:
+            logger.warning(f"Could not prune chunk cache entry {entry.path}: {e}")
+
+
+# Resolved TOCs of recently processed PDFs, keyed by a digest of the whole file
+TOC_CACHE_MAX_ENTRIES = 32
+_TOC_CACHE = OrderedDict()  # {blake2b digest of the PDF bytes: toc_map}
+_TOC_CACHE_LOCK = threading.Lock()
+
+
+def _extract_best_toc(doc: fitz.Document, failures: List[str]) -> Dict[int, str]:
+    """
+    Run the TOC tiers on `doc` until one gives a good-quality map: PyMuPDF metadata →
+    text parser → chapter-page scanner → Docling → Groq LLM. Tier errors go to `failures`.
+    """
     toc_map = extract_toc(doc)  # Tier 1: PyMuPDF metadata
     
     # Quality check: PyMuPDF may return messy internal bookmark names
@@ -662,7 +1084,7 @@ def process_pdf(pdf_bytes: bytes) -> List[Dict]:
         if len(toc) < 5:
             return "low"
         # Check for pure-number titles (e.g. "0", "1", "2")
-        numeric_count = sum(1 for t in toc.values() if re.match(r'^\d+$', t.strip()))
+        numeric_count = sum(1 for t in toc.values() if t.strip().isdecimal())
         if numeric_count > len(toc) * 0.5:
             return "low"
         # Check for messy bookmark artifacts
@@ -674,11 +1096,13 @@ def process_pdf(pdf_bytes: bytes) -> List[Dict]:
         return "good"
     
     toc_quality = assess_toc_quality(toc_map)
+    front_texts = None  # first pages' text, extracted once for all fallback tiers
     
     # Always try text parser if PyMuPDF quality is low
     if toc_quality == "low":
         logger.info(f"PyMuPDF TOC quality is low ({len(toc_map)} entries). Trying text parser...")
-        text_toc = extract_toc_from_text(doc)  # Tier 1.5: Text-based regex parser
+        front_texts = _get_first_n_texts(doc)
+        text_toc = extract_toc_from_text(doc, front_texts)  # Tier 1.5: Text-based regex parser
         if len(text_toc) > 0 and assess_toc_quality(text_toc) != "low":
             toc_map = text_toc
             toc_quality = "good"
@@ -695,16 +1119,22 @@ def process_pdf(pdf_bytes: bytes) -> List[Dict]:
             toc_map = page_toc
             toc_quality = assess_toc_quality(toc_map)
     
-    if toc_quality == "low":
+    # Docling (layout models) and Groq are expensive: only run them when the
+    # front matter could plausibly hold a TOC
+    use_model_tiers = toc_quality == "low" and front_matter_may_have_toc(doc, page_texts=front_texts)
+    if toc_quality == "low" and not use_model_tiers:
+        logger.info("No TOC cues in the first pages' text layer. Skipping Docling/Groq TOC tiers.")
+    
+    if use_model_tiers:
         logger.info(f"Text parser found {len(toc_map)} entries. Trying Docling...")
-        docling_toc = extract_toc_with_docling(pdf_bytes)  # Tier 2: Docling
+        docling_toc = extract_toc_with_docling(doc, front_texts, failures)  # Tier 2: Docling
         if len(docling_toc) > len(toc_map):
             toc_map = docling_toc
             toc_quality = assess_toc_quality(toc_map)
     
-    if toc_quality == "low":
+    if use_model_tiers and toc_quality == "low":
         logger.info(f"TOC still has only {len(toc_map)} entries. Trying Groq LLM...")
-        groq_toc = extract_toc_with_groq(pdf_bytes)  # Tier 3: Groq LLM
+        groq_toc = extract_toc_with_groq(doc, front_texts, failures)  # Tier 3: Groq LLM
         if len(groq_toc) > len(toc_map):
             toc_map = groq_toc
     
@@ -713,42 +1143,109 @@ def process_pdf(pdf_bytes: bytes) -> List[Dict]:
     else:
         logger.warning("No TOC found via any extraction method — chunks will not have chapter tags")
     
+    return toc_map
+
+
+def _process_pdf_uncached(pdf_bytes: bytes) -> Tuple[List[Dict], List[str]]:
+    """
+    HYBRID PDF Processor with improved chunking and TOC support.
+    Returns the chunks and a list of transient extraction failures (TOC tiers that
+    errored at runtime, OCR pages that errored); a non-empty list means the result is
+    degraded. Optional backends/keys that are simply not configured are not failures.
+    
+    Pipeline:
+    1. TOC extraction: PyMuPDF metadata → Docling → Groq LLM (3-tier fallback)
+    2. Text extraction: PyMuPDF text layer → Tesseract OCR (parallel)
+    3. Cross-page chunking: Concatenate all text, then chunk with sliding window
+    4. TOC summary chunk: Dedicated searchable chunk with all chapters/units
+    5. Chapter tagging: Each chunk tagged with its chapter from TOC
+    """
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    logger.info(f"Processing PDF with {len(doc)} pages")
+    failures = []
+    
+    # ─── STEP 1: Extract TOC (multi-tier with quality check) ───
+    # Re-ingesting the same file reuses its TOC, so Docling/Groq don't run again
+    # even when the chunk cache is disabled or didn't store this file
+    toc_key = hashlib.blake2b(pdf_bytes, digest_size=16).digest()
+    with _TOC_CACHE_LOCK:
+        toc_map = _TOC_CACHE.get(toc_key)
+    if toc_map is not None:
+        logger.info(f"Reusing TOC with {len(toc_map)} entries from an earlier run on this PDF")
+    else:
+        toc_map = _extract_best_toc(doc, failures)
+        if not failures:  # clean runs only: a tier that errored is retried next time
+            with _TOC_CACHE_LOCK:
+                _TOC_CACHE[toc_key] = toc_map
+                while len(_TOC_CACHE) > TOC_CACHE_MAX_ENTRIES:
+                    _TOC_CACHE.popitem(last=False)  # FIFO
+    
     # ─── STEP 2: Extract text from all pages ───
     page_texts = {}  # {page_num: text}
-    scan_pages = []  # Queue for OCR
+    scan_pages = []  # 0-based indices of pages queued for OCR
+    
+    # PyMuPDF is not thread-safe, so large books are split into page ranges
+    # that worker processes extract from their own copy of the document.
+    if len(doc) >= TEXT_EXTRACT_PARALLEL_MIN_PAGES and TEXT_EXTRACT_WORKERS > 1:
+        step = -(-len(doc) // TEXT_EXTRACT_WORKERS)
+        with ProcessPoolExecutor(max_workers=TEXT_EXTRACT_WORKERS, mp_context=_pdf_worker_context(),
+                                 initializer=_init_pdf_worker, initargs=(pdf_bytes,)) as executor:
+            futures = [
+                executor.submit(_extract_worker_text_range, start, min(start + step, len(doc)))
+                for start in range(0, len(doc), step)
+            ]
+            extracted = [item for future in futures for item in future.result()]
+    else:
+        extracted = _extract_text_range(doc, 0, len(doc))
     
-    for i, page in enumerate(doc):
+    for i, text in extracted:
         real_page_num = i + 1
-        text = page.get_text()
-        
-        if text.strip():
+        if text and text.strip():
             page_texts[real_page_num] = text
         else:
-            scan_pages.append((real_page_num, page))
+            scan_pages.append(i)
     
-    # Parallel OCR for scanned pages
-    if scan_pages:
-        logger.info(f"Detected {len(scan_pages)} scanned pages. Starting Parallel Tesseract OCR...")
-        
-        def ocr_page(args):
-            p_num, p_obj = args
+    paddle_ocr = get_paddle_ocr() if scan_pages and OCR_BACKEND == "paddle" else None
+    
+    # GPU OCR: one shared model instance, pages processed in order
+    if paddle_ocr is not None:
+        logger.info(f"Detected {len(scan_pages)} scanned pages. Starting PaddleOCR...")
+        for i in scan_pages:
             try:
-                pix = p_obj.get_pixmap(dpi=150)
-                img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-                text = pytesseract.image_to_string(img)
-                return p_num, text
+                text = paddle_image_to_string(paddle_ocr, doc[i].get_pixmap(dpi=OCR_DPI))
             except Exception as e:
-                logger.error(f"OCR failed for Page {p_num}: {e}")
-                return p_num, ""
-        
-        with ThreadPoolExecutor(max_workers=8) as executor:
-            results = list(executor.map(ocr_page, scan_pages))
-        
-        for p_num, text in results:
+                logger.error(f"OCR failed for Page {i + 1}: {e}")
+                failures.append(f"ocr: page {i + 1}: {e}")
+                continue
             if text.strip():
-                page_texts[p_num] = text
+                page_texts[i + 1] = text
+        logger.info(f"OCR Complete. Processed {len(scan_pages)} pages.")
+    
+    # Parallel OCR for scanned pages
+    elif scan_pages:
+        logger.info(f"Detected {len(scan_pages)} scanned pages. Starting Parallel Tesseract OCR...")
+        ocr_count = 0
+        
+        # Rendering is CPU-bound Python/MuPDF work, so each worker process opens
+        # its own copy of the document and renders + OCRs a small batch of pages.
+        batches = [scan_pages[k:k + OCR_PAGES_PER_TASK] for k in range(0, len(scan_pages), OCR_PAGES_PER_TASK)]
+        workers = min(OCR_MAX_WORKERS, os.cpu_count() or 1, len(batches))
+        with ProcessPoolExecutor(max_workers=workers, mp_context=_pdf_worker_context(),
+                                 initializer=_init_pdf_worker, initargs=(pdf_bytes,)) as executor:
+            futures = [executor.submit(_ocr_page_batch, batch) for batch in batches]
+            for future in as_completed(futures):
+                for i, text in future.result():
+                    ocr_count += 1
+                    if text is None:
+                        failures.append(f"ocr: page {i + 1}")
+                    elif text.strip():
+                        page_texts[i + 1] = text
         
-        logger.info(f"OCR Complete. Extracted text from {len(results)} pages.")
+        logger.info(f"OCR Complete. Extracted text from {ocr_count} pages.")
+    
+    # All page text is collected; release the document and MuPDF's cached resources
+    doc.close()
+    fitz.TOOLS.store_shrink(100)
     
     # ─── STEP 3: Cross-page chunking with chapter awareness ───
     chunks = []
@@ -757,16 +1254,17 @@ def process_pdf(pdf_bytes: bytes) -> List[Dict]:
     ordered_pages = sorted(page_texts.items())
     
     # Group pages by chapter for chapter-aware chunking
+    chapter_index = build_chapter_index(toc_map)
     chapter_groups = {}  # {chapter_name: [(page_num, text), ...]}
     for page_num, text in ordered_pages:
-        chapter = get_chapter_for_page(page_num, toc_map)
+        chapter = chapter_at_page(page_num, chapter_index)
         if chapter not in chapter_groups:
             chapter_groups[chapter] = []
         chapter_groups[chapter].append((page_num, text))
     
-    # Chunk within each chapter group (preserves chapter boundaries)
+    # Concatenate the page texts of each chapter group
+    chapter_texts = []  # [(chapter, pages, combined_text, page_boundaries), ...]
     for chapter, pages in chapter_groups.items():
-        # Concatenate all page texts in this chapter
         combined_text = ""
         page_boundaries = []  # Track where each page's text starts
         
@@ -778,41 +1276,58 @@ def process_pdf(pdf_bytes: bytes) -> List[Dict]:
             })
             combined_text += text + "\n\n"
         
-        if not combined_text.strip():
-            continue
+        if combined_text.strip():
+            chapter_texts.append((chapter, pages, combined_text, page_boundaries))
+    
+    # Tokenize every chapter in one batched call (tiktoken spreads it over threads).
+    # encode_ordinary skips the special-token scan: PDF text is plain text, and a
+    # literal "<|endoftext|>" in a book must not make encode() raise
+    enc = get_tokenizer()
+    chapter_tokens = enc.encode_ordinary_batch(
+        [combined_text for _, _, combined_text, _ in chapter_texts],
+        num_threads=os.cpu_count() or 8,
+    )
+    
+    seen_chunks = set()  # 16-byte blake2b digests of chunk texts already emitted
+    
+    # Chunk within each chapter group (preserves chapter boundaries)
+    for (chapter, pages, combined_text, page_boundaries), tokens in zip(chapter_texts, chapter_tokens):
+        # Split the chapter's tokens into windows and decode them together
+        windows = _split_tokens(tokens)
+        chapter_chunks = enc.decode_batch(windows)
         
-        # Split the combined chapter text into chunks
-        chapter_chunks = split_text_by_tokens(combined_text, CHUNK_SIZE, CHUNK_OVERLAP)
+        # Character offset of each window in the chapter text (no substring search)
+        chunk_starts = _window_char_starts(combined_text, tokens, len(windows))
+        page_starts = [boundary["start_char"] for boundary in page_boundaries]
         
         # Map each chunk back to its source page(s)
-        char_pos = 0
-        for chunk_text in chapter_chunks:
+        for chunk_text, window, chunk_start in zip(chapter_chunks, windows, chunk_starts):
             if not chunk_text.strip():
                 continue
             
-            # Find which page this chunk primarily belongs to
-            chunk_start = combined_text.find(chunk_text[:100])  # Find by first 100 chars
-            if chunk_start == -1:
-                chunk_start = char_pos
+            # Identical windows (repeated boilerplate pages/sections) would only
+            # be embedded and retrieved twice; keep the first occurrence
+            digest = hashlib.blake2b(chunk_text.encode("utf-8"), digest_size=16).digest()
+            if digest in seen_chunks:
+                continue
+            seen_chunks.add(digest)
             
-            primary_page = pages[0][0]  # Default to first page of chapter
-            for boundary in page_boundaries:
-                if boundary["start_char"] <= chunk_start < boundary["end_char"]:
-                    primary_page = boundary["page"]
-                    break
+            # The page whose text the chunk starts in (the page separator counts
+            # toward the page before it)
+            idx = bisect.bisect_right(page_starts, chunk_start) - 1
+            primary_page = page_boundaries[idx]["page"] if idx >= 0 else pages[0][0]
             
             chunks.append({
                 "text": chunk_text,
                 "page": primary_page,
                 "chapter": chapter,
                 "section_type": "content",
-                "token_count": count_tokens(chunk_text),
-                "original_text": chunk_text
+                "token_count": len(window),  # already known; no re-encode of the decoded text
             })
-            char_pos = chunk_start + len(chunk_text)
     
-    # Sort by page number
-    chunks.sort(key=lambda x: x['page'])
+    # Sort by page number. Each chapter group is already in page order, so this
+    # is a stable merge of those runs (Timsort detects them), not a full sort.
+    chunks.sort(key=itemgetter('page'))
     
     # Filter and merge small chunks
     chunks = filter_and_merge_small_chunks(chunks, min_size=100)
@@ -830,14 +1345,13 @@ def process_pdf(pdf_bytes: bytes) -> List[Dict]:
             "chapter": "Table of Contents",
             "section_type": "toc",
             "token_count": count_tokens(toc_text),
-            "original_text": toc_text
         }
         chunks.insert(0, toc_chunk)  # Put TOC first
         logger.info(f"Created dedicated TOC chunk with {len(toc_map)} entries")
     
     logger.info(f"Final chunk count: {len(chunks)}")
     logger.info(f"Chapters detected: {set(c['chapter'] for c in chunks)}")
-    return chunks
+    return chunks, failures
 
 
 def filter_and_merge_small_chunks(chunks: List[Dict], min_size: int = 100) -> List[Dict]:
@@ -872,7 +1386,6 @@ def filter_and_merge_small_chunks(chunks: List[Dict], min_size: int = 100) -> Li
                         'chapter': current['chapter'],
                         'section_type': 'content',
                         'token_count': merged_tokens,
-                        'original_text': current['original_text'] + "\n\n" + next_chunk['original_text']
                     }
                     filtered.append(merged)
                     i += 2  # Skip both chunks
@@ -885,37 +1398,61 @@ def filter_and_merge_small_chunks(chunks: List[Dict], min_size: int = 100) -> Li
     return filtered
 
 
-def split_text_by_tokens(text: str, chunk_size: int, overlap: int) -> List[str]:
-    """Split text into chunks of max `chunk_size` tokens with overlap"""
-    if not text:
+def _split_tokens(tokens: List[int], chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> List[List[int]]:
+    """Slice token ids into windows of max `chunk_size` tokens with overlap"""
+    step = chunk_size - overlap
+    if step <= 0:
+        raise ValueError(f"overlap ({overlap}) must be smaller than chunk_size ({chunk_size})")
+    if not tokens:
         return []
-        
-    enc = tiktoken.get_encoding("cl100k_base")
-    tokens = enc.encode(text)
     
-    if len(tokens) == 0:
-        return []
+    # Window starts advance by `step` until a window reaches the end of the
+    # tokens, so the last start is the first multiple of `step` >= n - chunk_size.
+    last_start = max(len(tokens) - chunk_size, 0)
+    return [tokens[start:start + chunk_size] for start in range(0, last_start + step, step)]
+
+
+def _window_char_starts(text: str, tokens: List[int], n_windows: int,
+                        step: int = CHUNK_SIZE - CHUNK_OVERLAP) -> List[int]:
+    """
+    Character offset in `text` at which each of the first `n_windows` `_split_tokens`
+    windows of `tokens` (the encoding of `text`) starts.
     
-    chunks = []
-    start = 0
-    while start < len(tokens):
-        end = min(start + chunk_size, len(tokens))
-        chunk_tokens = tokens[start:end]
-        chunk_text = enc.decode(chunk_tokens)
-        chunks.append(chunk_text)
-        
-        if end == len(tokens):
-            break
-            
-        start += (chunk_size - overlap)
+    Window k starts k * `step` tokens in. Offsets are summed in UTF-8 bytes, which
+    are exact even where a token boundary splits a multi-byte character, and then
+    mapped to the index of the character containing that byte.
+    """
+    if n_windows <= 0:
+        return []
+    enc = get_tokenizer()
+    byte_starts = list(accumulate(
+        (len(enc.decode_bytes(tokens[i:i + step])) for i in range(0, (n_windows - 1) * step, step)),
+        initial=0,
+    ))
+    encoded = np.frombuffer(text.encode("utf-8"), dtype=np.uint8)
+    # Index of the character each byte belongs to: count of lead (non-continuation) bytes so far
+    char_index = np.cumsum((encoded & 0xC0) != 0x80) - 1
+    return char_index[byte_starts].tolist()
+
+
+def split_text_by_tokens(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> List[str]:
+    """Split text into chunks of max `chunk_size` tokens with overlap"""
+    if not text:
+        return []
         
-    return chunks
+    enc = get_tokenizer()
+    return enc.decode_batch(_split_tokens(enc.encode_ordinary(text), chunk_size, overlap))
 
 
 # =============================================================================
 # PROMPT BUILDING — Teacher persona with chapter context
 # =============================================================================
 
+_PROMPT_STRUCTURAL_RE = re.compile(
+    r'chapter|unit|table of contents|toc|topics|syllabus|index|what are the|list all|how many (?:units|chapters)'
+)
+
+
 def build_system_user_prompt(context_docs: List[Dict], question: str) -> Tuple[str, str]:
     """
     Build prompt with Teacher Persona.
@@ -923,11 +1460,7 @@ def build_system_user_prompt(context_docs: List[Dict], question: str) -> Tuple[s
     """
     
     # Detect structural query type
-    is_structural = any(k in question.lower() for k in [
-        "chapter", "unit", "table of contents", "toc", "topics",
-        "syllabus", "index", "what are the", "list all", "how many units",
-        "how many chapters"
-    ])
+    is_structural = _PROMPT_STRUCTURAL_RE.search(question.lower()) is not None
     
     system_prompt = """You are an expert and friendly teacher. 
 Your goal is to help the student understand the concept using the provided educational material.
@@ -948,19 +1481,21 @@ List ALL chapters/units/topics with page numbers in a clear numbered list format
 Do NOT say "chapters are not explicitly listed" if there is a Table of Contents excerpt in the context.
 """
     
-    context_str = ""
+    # Collect the blocks and join once instead of re-copying a growing string per doc
+    context_blocks = []
     for doc in context_docs:
         page = doc.get("page", "?")
         text = doc.get("text", "").strip()
         chapter = doc.get("chapter", "")
         
         # Build header with chapter info
-        if chapter and chapter not in ["Unknown", ""]:
+        if chapter and chapter != "Unknown":
             header = f"[Chapter: {chapter} | Page {page}]"
         else:
             header = f"[Page {page}]"
         
-        context_str += f"\n{header}:\n{text}\n"
+        context_blocks.append(f"\n{header}:\n{text}\n")
+    context_str = "".join(context_blocks)
 
     user_prompt = f"""Context from Textbook:
 {context_str}